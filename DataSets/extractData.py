@@ -1,77 +1,150 @@
 import rosbag
 from .datasetSettings import *
 import rospy
-from DataTypes.measurement import generate_measurement
-import scipy.io
-import pymap3d as pm
+from DataTypes.measurement import generate_measurement, Measurement, MeasurementType, IMUBlock
+from .measurementCache import MeasurementCache, nsec_to_time, time_to_nsec
+from .prefetch import Prefetcher
+from .imageDecoding import ParallelImageDecoder
+from .timestampIndex import TimestampIndex
+from .measurementMerge import merge_measurements
+from .trilaterationSource import TrilaterationSource
 import numpy as np
+from Utils.ned_frame import NEDFrame
 
 
 class ROSData:
 
-    def __init__(self, dataset_number: int) -> None:
+    initialization_topics = ["/sentiboard/adis", "/ublox2/fix", "/camera/image_raw/compressed"]
+
+    def __init__(self, dataset_number: int, prefetch_size=0, prefetch_images=False, decode_workers=0, decode_options=None) -> None:
         print("Initialize ROS dataset number ", dataset_number, ".\n", end="")
 
+        # Grayscale and reduction of the decoded camera frames, given to every camera measurement when it is read
+        self.decode_options = decode_options or {}
+
         # Initializes the dataset settings
         self.dataset_settings = ROSData.select_dataset(dataset_number)
+        self.enabled_topics = self.dataset_settings.enabled_topics
 
         self.initialization_step_time = 0
 
+        # Read-ahead of the measurements on a producer thread, disabled when prefetch_size is 0
+        self.prefetch_size = prefetch_size
+        self.prefetch_images = prefetch_images
+        self.prefetcher = None
+
+        # Decoding of the camera frames in a process pool, disabled when decode_workers is 0
+        self.image_decoder = ParallelImageDecoder(decode_workers) if decode_workers else None
+
         # Initializes the rosbag
         self.bag = rosbag.Bag(self.dataset_settings.filepath)
-        self.bag_start_time = rospy.Time(self.bag.get_start_time() + self.dataset_settings.bag_start_time_offset + self.initialization_step_time)
+        self.timestamp_index = TimestampIndex.load_or_build(self.dataset_settings, self.bag)
+        self.bag_origin_time = self.timestamp_index.bag_start_time
+        self.bag_start_time = rospy.Time(self.bag_origin_time + self.dataset_settings.bag_start_time_offset + self.initialization_step_time)
         self.bag_end_time = self.get_bag_end_time()
         self.extract_initial_pose()
 
     def extract_initial_pose(self):
-        for _, msg, t in self.bag.read_messages(topics=["/ublox2/fix"], start_time=self.bag_start_time):
+        # The time of the first fix is found in the index, so only that message is read
+        time = self.timestamp_index.first_after("/ublox2/fix", self.bag_start_time)
+        if time is None:
+            raise ValueError(f"No GNSS fix in {self.dataset_settings.filepath} after the start time {self.bag_start_time.to_sec()}")
+        for _, msg, _ in self.bag.read_messages(topics=["/ublox2/fix"], start_time=time, end_time=time):
             data = msg
-            time = t
             break
         self.bag_start_time = time
         return self.convert_GNSS_to_NED(data)
 
+    def ned_frame(self):
+        # The origin file is only loaded on the first call
+        return NEDFrame.from_mat(self.dataset_settings.ned_origin_filepath())
+
     def extract_ned_origin(self):
-        data = scipy.io.loadmat(self.dataset_settings.ned_origin_filepath())
-        latitude = data["lat0"][0][0]
-        longitude = data["lon0"][0][0]
-        altitiude = data["height0"][0][0]
-        return np.array([latitude, longitude, altitiude])
+        return self.ned_frame().origin
 
     def convert_GNSS_to_NED(self, msg):
-        ned_origin = self.extract_ned_origin()
-        n, e, d = pm.geodetic2ned(
-            msg.latitude,
-            msg.longitude,
-            msg.altitude,
-            ned_origin[0],  # NED origin
-            ned_origin[1],  # NED origin
-            ned_origin[2],  # NED origin
-            ell=pm.Ellipsoid("wgs84"),
-            deg=True,
-        )
-        #print("NED Origin",np.array([n, e, d]))
-        return np.array([n, e, d])
+        return self.convert_geodetic_to_NED(msg.latitude, msg.longitude, msg.altitude)
 
-    def generate_initialization_gnss_imu(self, actual_value=False):
+    def convert_geodetic_to_NED(self, latitude, longitude, altitude):
+        """Converts a fix, or whole arrays of fixes, to the NED frame of the dataset"""
+        return self.ned_frame().geodetic_to_ned(latitude, longitude, altitude)
+
+    def initialization_time_window(self, actual_value=False):
+        start_time = rospy.Time(self.bag_origin_time + self.dataset_settings.bag_start_time_offset - 10)
         if not actual_value:
-            start_time = rospy.Time(self.bag.get_start_time() + self.dataset_settings.bag_start_time_offset - 10)
-            end_time = rospy.Time(self.bag.get_start_time() + self.dataset_settings.bag_start_time_offset + self.initialization_step_time)
+            end_time = rospy.Time(self.bag_origin_time + self.dataset_settings.bag_start_time_offset + self.initialization_step_time)
         else:
-            start_time = rospy.Time(self.bag.get_start_time() + self.dataset_settings.bag_start_time_offset - 10)
             end_time = self.bag_end_time
-        topics = ["/sentiboard/adis", "/ublox2/fix", "/camera/image_raw/compressed"]
-        for topic, msg, t in self.bag.read_messages(topics=topics, start_time=start_time, end_time=end_time):
-            yield generate_measurement(topic, msg, t)
+        return start_time, end_time
+
+    def generate_initialization_gnss_imu(self, actual_value=False):
+        start_time, end_time = self.initialization_time_window(actual_value)
+        return self.prefetch(self.decode_images(self.read_measurements(self.initialization_topics, start_time, end_time)))
+
+    def generate_initialization_gnss_imu_blocks(self, actual_value=False):
+        start_time, end_time = self.initialization_time_window(actual_value)
+        return self.prefetch(self.decode_images(self.read_measurement_blocks(self.initialization_topics, start_time, end_time)))
 
     def generate_measurements(self):
-        for topic, msg, t in self.bag.read_messages(topics=self.dataset_settings.enabled_topics, start_time=self.bag_start_time, end_time=self.bag_end_time):
-            yield generate_measurement(topic, msg, t)
+        return self.prefetch(self.decode_images(self.read_measurements(self.enabled_topics, self.bag_start_time, self.bag_end_time)))
+
+    def generate_measurement_blocks(self):
+        """Same as generate_measurements, but the IMU samples between two other measurements are yielded as one IMUBlock"""
+        return self.prefetch(self.decode_images(self.read_measurement_blocks(self.enabled_topics, self.bag_start_time, self.bag_end_time)))
+
+    def decode_images(self, measurements):
+        """Decodes the camera frames in the process pool when it is enabled, keeping the measurement order"""
+        if self.image_decoder is None:
+            return measurements
+        return self.image_decoder.decode(measurements)
+
+    def stop_image_decoder(self):
+        """Stops the decoder processes, the camera frames are decoded when their image is used"""
+        if self.image_decoder is not None:
+            self.image_decoder.close()
+            self.image_decoder = None
+
+    def prefetch(self, measurements):
+        """Reads and decodes the measurements on a producer thread when prefetching is enabled"""
+        if not self.prefetch_size:
+            return measurements
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        prepare = ROSData.decode_camera_image if self.prefetch_images else None
+        self.prefetcher = Prefetcher(measurements, self.prefetch_size, prepare)
+        return self.prefetcher
+
+    @staticmethod
+    def decode_camera_image(measurement):
+        if measurement.measurement_type == MeasurementType.CAMERA:
+            measurement.image
+
+    def read_measurements(self, topics, start_time, end_time):
+        for topic, msg, t in self.bag.read_messages(topics=topics, start_time=start_time, end_time=end_time):
+            yield generate_measurement(topic, msg, t, self.decode_options)
+
+    def read_measurement_blocks(self, topics, start_time, end_time):
+        # The IMU messages are read directly into the block columns without creating IMU_Measurement objects
+        time, linear_acceleration, angular_velocity = [], [], []
+        for topic, msg, t in self.bag.read_messages(topics=topics, start_time=start_time, end_time=end_time):
+            if Measurement.select_measurement_type(topic) == MeasurementType.IMU:
+                time.append(t.to_time())
+                linear_acceleration.append((msg.linear_acceleration.x, msg.linear_acceleration.y, msg.linear_acceleration.z))
+                angular_velocity.append((msg.angular_velocity.x, msg.angular_velocity.y, msg.angular_velocity.z))
+                continue
+
+            if time:
+                yield IMUBlock.from_columns(time, linear_acceleration, angular_velocity)
+                time, linear_acceleration, angular_velocity = [], [], []
+            yield generate_measurement(topic, msg, t, self.decode_options)
+
+        if time:
+            yield IMUBlock.from_columns(time, linear_acceleration, angular_velocity)
 
     def get_bag_end_time(self):
         if self.dataset_settings.bag_duration < 0:
-            return rospy.Time(self.bag.get_end_time())
-        return rospy.Time(self.bag.get_start_time() + self.dataset_settings.bag_start_time_offset + self.dataset_settings.bag_duration)
+            return rospy.Time(self.timestamp_index.bag_end_time)
+        return rospy.Time(self.bag_origin_time + self.dataset_settings.bag_start_time_offset + self.dataset_settings.bag_duration)
 
     @staticmethod
     def select_dataset(id: int):
@@ -83,6 +156,62 @@ class ROSData:
             return DatasetSettings_Trondheim4()
 
 
+class CachedROSData(ROSData):
+    """ROSData backend streaming from the columnar measurement cache instead of the rosbag.
+
+    The cache is extracted from the rosbag on the first run of a dataset window,
+    later runs only memory map the cached columns. The camera topic is not cached, so
+    topics selects the streamed topics (the enabled topics of the dataset by default),
+    and a topic that is not cached raises a ValueError when it is read.
+    """
+
+    def __init__(self, dataset_number: int, prefetch_size=0, topics=None) -> None:
+        print("Initialize cached ROS dataset number ", dataset_number, ".\n", end="")
+
+        # Initializes the dataset settings
+        self.dataset_settings = ROSData.select_dataset(dataset_number)
+        self.enabled_topics = topics if topics is not None else self.dataset_settings.enabled_topics
+        self.initialization_topics = [topic for topic in ROSData.initialization_topics if topics is None or topic in topics]
+
+        self.initialization_step_time = 0
+
+        # There are no camera frames to decode
+        self.prefetch_size = prefetch_size
+        self.prefetch_images = False
+        self.prefetcher = None
+        self.image_decoder = None
+
+        # Extracts the cache from the rosbag if it does not exist
+        if not MeasurementCache.exists(self.dataset_settings):
+            with rosbag.Bag(self.dataset_settings.filepath) as bag:
+                MeasurementCache.build(self.dataset_settings, bag)
+        self.cache = MeasurementCache(self.dataset_settings)
+
+        self.bag_origin_time = self.cache.bag_start_time
+        self.bag_start_time = rospy.Time(self.bag_origin_time + self.dataset_settings.bag_start_time_offset + self.initialization_step_time)
+        self.bag_end_time = self.get_bag_end_time()
+        self.extract_initial_pose()
+
+    def extract_initial_pose(self):
+        columns = self.cache.columns["/ublox2/fix"]
+        index, end = self.cache.rows_between("/ublox2/fix", time_to_nsec(self.bag_start_time), time_to_nsec(self.bag_end_time))
+        if index == end:
+            raise ValueError(f"No GNSS fix in {self.dataset_settings.filepath} after the start time {self.bag_start_time.to_sec()}")
+        self.bag_start_time = nsec_to_time(int(columns["time"][index]))
+        return self.convert_geodetic_to_NED(float(columns["latitude"][index]), float(columns["longitude"][index]), float(columns["altitude"][index]))
+
+    def read_measurements(self, topics, start_time, end_time):
+        return self.cache.generate_measurements(topics, start_time, end_time)
+
+    def read_measurement_blocks(self, topics, start_time, end_time):
+        return self.cache.generate_measurement_blocks(topics, start_time, end_time)
+
+    def get_bag_end_time(self):
+        if self.dataset_settings.bag_duration < 0:
+            return rospy.Time(self.cache.bag_end_time)
+        return rospy.Time(self.bag_origin_time + self.dataset_settings.bag_start_time_offset + self.dataset_settings.bag_duration)
+
+
 class RosDataTrilateration:
 
     # TODO: Sørg for at UWB starter på rett sted
@@ -95,97 +224,53 @@ class RosDataTrilateration:
 
         # Initializes the rosbag
         self.bag = rosbag.Bag(self.dataset_settings.filepath)
+        self.timestamp_index = TimestampIndex.load_or_build(self.dataset_settings, self.bag)
         self.bag_start_time = rospy.Time(
-            self.bag.get_start_time() + self.dataset_settings.bag_start_time_offset)
+            self.timestamp_index.bag_start_time + self.dataset_settings.bag_start_time_offset)
         self.bag_end_time = self.get_bag_end_time()
         self.extract_initial_pose()
+        self.trilateration_source = TrilaterationSource(self.dataset_settings)
         print("Starttime", self.bag_start_time)
 
     def extract_initial_pose(self):
-        for _, msg, t in self.bag.read_messages(topics=["/ublox2/fix"], start_time=self.bag_start_time):
+        # The time of the first fix is found in the index, so only that message is read
+        time = self.timestamp_index.first_after("/ublox2/fix", self.bag_start_time)
+        if time is None:
+            raise ValueError(f"No GNSS fix in {self.dataset_settings.filepath} after the start time {self.bag_start_time.to_sec()}")
+        for _, msg, _ in self.bag.read_messages(topics=["/ublox2/fix"], start_time=time, end_time=time):
             data = msg
-            time = t
             break
         self.bag_start_time = time
         return self.convert_GNSS_to_NED(data)
 
+    def ned_frame(self):
+        return NEDFrame.from_mat(self.dataset_settings.ned_origin_filepath())
+
     def extract_ned_origin(self):
-        data = scipy.io.loadmat(self.dataset_settings.ned_origin_filepath())
-        latitude = data["lat0"][0][0]
-        longitude = data["lon0"][0][0]
-        altitiude = data["height0"][0][0]
-        return np.array([latitude, longitude, altitiude])
+        return self.ned_frame().origin
 
     def convert_GNSS_to_NED(self, msg):
-        ned_origin = self.extract_ned_origin()
-        n, e, d = pm.geodetic2ned(
-            msg.latitude,
-            msg.longitude,
-            msg.altitude,
-            ned_origin[0],  # NED origin
-            ned_origin[1],  # NED origin
-            ned_origin[2],  # NED origin
-            ell=pm.Ellipsoid("wgs84"),
-            deg=True,
-        )
-        return np.array([n, e, d])
+        return self.ned_frame().geodetic_to_ned(msg.latitude, msg.longitude, msg.altitude)
 
     def get_bag_end_time(self):
         if self.dataset_settings.bag_duration < 0:
-            return rospy.Time(self.bag.get_end_time())
-        return rospy.Time(self.bag.get_start_time() + self.dataset_settings.bag_start_time_offset + self.dataset_settings.bag_duration)
+            return rospy.Time(self.timestamp_index.bag_end_time)
+        return rospy.Time(self.timestamp_index.bag_start_time + self.dataset_settings.bag_start_time_offset + self.dataset_settings.bag_duration)
 
     def generate_trilateration_combo_measurements(self):
         """
-            Sjekke hvem som har størst tidssteg
-            Returnere den som har minst
+            Merges the trilateration fixes and the bag measurements by time,
+            the bag measurement is returned first on equal time stamps
         """
-        tri_generator = self.skip_to_right_time_step(
-            self.generate_trilateration_measurement())
-        imu_generator = self.generate_measurements()
-
-        tri_meas = next(tri_generator)
-        imu_meas = next(imu_generator)
-        while True:
-            if tri_meas.time < imu_meas.time.to_time():
-                yield tri_meas
-                tri_meas = next(tri_generator)
-            else:
-                yield imu_meas
-                imu_meas = next(imu_generator)
-
-            if not tri_meas and not imu_meas:
-                return None
-
-    def skip_to_right_time_step(self, trilateration_generator):
-        tri_time = next(trilateration_generator)
-        while tri_time.time < self.bag_start_time.to_time():
-            tri_time = next(trilateration_generator)
-        return trilateration_generator
+        return merge_measurements(self.generate_measurements(), self.generate_trilateration_measurement())
 
     def generate_measurements(self):
         for topic, msg, t in self.bag.read_messages(topics=self.dataset_settings.enabled_topics, start_time=self.bag_start_time, end_time=self.bag_end_time):
             yield generate_measurement(topic, msg, t)
 
-    def extract_trilateration_measurements(self):
-        trilateration_data = scipy.io.loadmat(
-            self.dataset_settings.trilateration_filepath())
-        x_list = trilateration_data["pos_sensor"][0][0][0][0]
-        y_list = trilateration_data["pos_sensor"][0][0][1][0]
-        z_list = trilateration_data["pos_sensor"][0][0][4][0]
-        time_list = trilateration_data["pos_sensor"][0][0][6][0]
-        list_of_measurements = []
-
-        for x, y, z, time in zip(x_list, y_list, z_list, time_list):
-            list_of_measurements.append(generate_measurement(
-                "uwb_trilateration", {"x": x, "y": y, "z": z}, time))
-
-        return list_of_measurements
-
     def generate_trilateration_measurement(self):
-        measurements = self.extract_trilateration_measurements()
-        for measurement in measurements:
-            yield measurement
+        # Starts at the first fix at or after the bag start time
+        return self.trilateration_source.generate_measurements(self.bag_start_time.to_time())
 
     @staticmethod
     def select_dataset(id: int):
@@ -1,7 +1,7 @@
 from pathlib import Path
 from time import time
-import scipy.io
 from .datasetSettings import *
+from .groundTruthStore import GroundTruthStore, closest_index
 import numpy as np
 
 """
@@ -14,8 +14,7 @@ Kalkulere hastigheten i samme tidspunkt
 class GroundTruthEstimates:
 
     def __init__(self, dataset_id, pre_initialization=None) -> None:
-        self.files = scipy.io.loadmat(
-            GroundTruthEstimates.generate_path(dataset_id))
+        self.store = GroundTruthStore.get(dataset_id)
         self.datasetSettings = GroundTruthEstimates.select_dataset(dataset_id)
 
         """
@@ -40,8 +39,8 @@ class GroundTruthEstimates:
         return np.array([self.v_north[0], self.v_east[0], self.v_down[0]])
 
     def extract_data(self, pre_initialization=None):
-        self.mat_file_to_dict()
-        self.time = np.array(self.data_dictionary["tow"][0])
+        tow, position, roll, pitch, yaw, velocity = self.store.load("tow", "p_lb_L_hat", "roll_hat", "pitch_hat", "yaw_hat", "v_eb_n_hat")
+        self.time = tow[0]
 
         # Compensate for time offset
         if pre_initialization:
@@ -53,44 +52,37 @@ class GroundTruthEstimates:
         self.time = self.time[self.start_index:] - self.datasetSettings.gt_time_offset
         print("Start time of ground truth:", self.time[0])
 
-        self.north = np.array(self.data_dictionary["p_lb_L_hat"][0])[
-            self.start_index:]
-        self.east = np.array(self.data_dictionary["p_lb_L_hat"][1])[
-            self.start_index:]
-        self.down = np.array(self.data_dictionary["p_lb_L_hat"][2])[
-            self.start_index:]
-        self.roll = np.array(self.data_dictionary["roll_hat"][0])[
-            self.start_index:]
-        self.pitch = np.array(self.data_dictionary["pitch_hat"][0])[
-            self.start_index:]
-        self.yaw = np.array(self.data_dictionary["yaw_hat"][0])[
-            self.start_index:]
-
-        self.v_north = self.data_dictionary["v_eb_n_hat"][0][self.start_index:]
-        self.v_east = self.data_dictionary["v_eb_n_hat"][1][self.start_index:]
-        self.v_down = self.data_dictionary["v_eb_n_hat"][2][self.start_index:]
-
-        self.gt_transelation = np.array(self.data_dictionary["p_lb_L_hat"]).astype(
-            "float")[:, self.start_index:]
+        self.north = position[0][self.start_index:]
+        self.east = position[1][self.start_index:]
+        self.down = position[2][self.start_index:]
+        self.roll = roll[0][self.start_index:]
+        self.pitch = pitch[0][self.start_index:]
+        self.yaw = yaw[0][self.start_index:]
+
+        self.v_north = velocity[0][self.start_index:]
+        self.v_east = velocity[1][self.start_index:]
+        self.v_down = velocity[2][self.start_index:]
+
+        self.gt_transelation = position[:, self.start_index:].copy()
         self.gt_angels = np.zeros((len(self.time), 3)).astype("float")
         self.gt_angels[:, 0] = self.roll.copy()
         self.gt_angels[:, 1] = self.pitch.copy()
         self.gt_angels[:, 2] = self.yaw.copy()
 
-    def find_index_closest(self, time_array, start_time):
-        temp_array = time_array - (time_array[0] - self.time_offset)
-        return (np.abs(temp_array - start_time)).argmin()
+    def pose_at(self, times):
+        """Interpolated [roll, pitch, yaw, north, east, down] at times on the time base of self.time"""
+        return self.store.pose_at(np.asarray(times, dtype=float) + self.datasetSettings.gt_time_offset)
 
-    def mat_file_to_dict(self):
-        keys = ["tow", "navigation_frame", "roll_hat", "pitch_hat", "yaw_hat", "omega_ib_b_hat", "ars_bias_hat", "ars_bias_total_hat", "acc_bias_hat", "gravity_hat",
-                "tmo_innovation", "T_tmo_innovation", "T_tmo_innovation_sum", "p_lb_L_hat", "v_eb_n_hat", "speed_course_hat", "innov", "innov_covariance", "P_hat"]
-        self.data_dictionary = {}
-        for element, key in zip(self.files["obsv_estimates"][0][0], keys):
-            self.data_dictionary[key] = element
+    def velocity_at(self, times):
+        """Interpolated [v_north, v_east, v_down] at times on the time base of self.time"""
+        return self.store.velocity_at(np.asarray(times, dtype=float) + self.datasetSettings.gt_time_offset)
+
+    def find_index_closest(self, time_array, start_time):
+        return int(closest_index(time_array, start_time + time_array[0] - self.time_offset))
 
     @staticmethod
     def generate_path(dataset_id):
-        return Path.joinpath(Path(__file__).parent.absolute(), "Gnssdata/obsv_estimates" + str(dataset_id) + ".mat")
+        return GroundTruthStore.generate_path(dataset_id)
 
     @staticmethod
     def select_dataset(id: int):
@@ -0,0 +1,119 @@
+from pathlib import Path
+import numpy as np
+import scipy.io
+
+"""
+Lazily loaded ground truth of the obsv_estimates{N}.mat files.
+
+The first time a field is requested the whole obsv_estimates struct of the .mat file is
+loaded, including the large P_hat and innov_covariance fields, and the requested fields
+are written to DataSets/Cache/ground_truth{N}/<field>.npy. Later runs only load the .npy
+files of the fields they need.
+"""
+
+
+def closest_index(sorted_array, values):
+    """Index of the closest element of a sorted array for each value (first index on ties)"""
+    values = np.asarray(values, dtype=float)
+    if len(sorted_array) == 1:
+        return np.zeros(values.shape, dtype=int)
+    index = np.clip(np.searchsorted(sorted_array, values, side="left"), 1, len(sorted_array) - 1)
+    left = sorted_array[index - 1]
+    right = sorted_array[index]
+    return np.where(values - left <= right - values, index - 1, index)
+
+
+def wrap_angle(angle):
+    return (angle + np.pi) % (2 * np.pi) - np.pi
+
+
+def interpolate(sorted_time, values, query_times, angles=False):
+    """Linear interpolation of the columns of values [N, ...] at query_times, clamped at the ends.
+
+    Angles are interpolated along the shortest arc and wrapped to [-pi, pi).
+    """
+    query_times = np.asarray(query_times, dtype=float)
+    if len(sorted_time) == 1:
+        return np.broadcast_to(values[0], query_times.shape + values.shape[1:]).copy()
+    index = np.clip(np.searchsorted(sorted_time, query_times, side="right"), 1, len(sorted_time) - 1)
+    t0 = sorted_time[index - 1]
+    t1 = sorted_time[index]
+    weight = np.clip((query_times - t0) / (t1 - t0), 0.0, 1.0)
+    weight = weight.reshape(weight.shape + (1,) * (values.ndim - 1))
+
+    v0 = values[index - 1]
+    v1 = values[index]
+    if angles:
+        return wrap_angle(v0 + weight * wrap_angle(v1 - v0))
+    return v0 + weight * (v1 - v0)
+
+
+class GroundTruthStore:
+
+    KEYS = ["tow", "navigation_frame", "roll_hat", "pitch_hat", "yaw_hat", "omega_ib_b_hat", "ars_bias_hat", "ars_bias_total_hat", "acc_bias_hat", "gravity_hat",
+            "tmo_innovation", "T_tmo_innovation", "T_tmo_innovation_sum", "p_lb_L_hat", "v_eb_n_hat", "speed_course_hat", "innov", "innov_covariance", "P_hat"]
+
+    # Stores shared by all ground truth users of a dataset in this process
+    _stores = {}
+
+    def __init__(self, dataset_id) -> None:
+        self.dataset_id = dataset_id
+        self.directory = Path.joinpath(Path(__file__).parent.absolute(), "Cache", f"ground_truth{dataset_id}")
+        self.fields = {}
+
+    @classmethod
+    def get(cls, dataset_id):
+        if dataset_id not in cls._stores:
+            cls._stores[dataset_id] = cls(dataset_id)
+        return cls._stores[dataset_id]
+
+    def load(self, *names):
+        """Returns the requested fields, extracting the missing ones from the .mat file in one pass"""
+        missing = [name for name in names if name not in self.fields and not self.field_filepath(name).exists()]
+        if missing:
+            self.extract(missing)
+
+        for name in names:
+            if name not in self.fields:
+                self.fields[name] = np.load(self.field_filepath(name))
+        return tuple(self.fields[name] for name in names)
+
+    def __getitem__(self, name):
+        return self.load(name)[0]
+
+    def extract(self, names):
+        print("Extracting ground truth fields", names, "of dataset", self.dataset_id)
+        files = scipy.io.loadmat(GroundTruthStore.generate_path(self.dataset_id), variable_names=["obsv_estimates"])
+        elements = dict(zip(GroundTruthStore.KEYS, files["obsv_estimates"][0][0]))
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for name in names:
+            np.save(self.field_filepath(name), np.asarray(elements[name], dtype=np.float64))
+
+    @property
+    def time(self):
+        return self["tow"][0]
+
+    def pose_at(self, times):
+        """Interpolated [roll, pitch, yaw, north, east, down] at the times of week, shape [N, 6]"""
+        tow, roll, pitch, yaw, position = self.load("tow", "roll_hat", "pitch_hat", "yaw_hat", "p_lb_L_hat")
+        angles = np.stack([roll[0], pitch[0], yaw[0]], axis=1)
+        return np.concatenate([
+            interpolate(tow[0], angles, times, angles=True),
+            interpolate(tow[0], position[:3].T, times)
+        ], axis=-1)
+
+    def velocity_at(self, times):
+        """Interpolated NED velocity at the times of week, shape [N, 3]"""
+        tow, velocity = self.load("tow", "v_eb_n_hat")
+        return interpolate(tow[0], velocity[:3].T, times)
+
+    def field_filepath(self, name):
+        return Path.joinpath(self.directory, name + ".npy")
+
+    @staticmethod
+    def generate_path(dataset_id):
+        return Path.joinpath(Path(__file__).parent.absolute(), "Gnssdata/obsv_estimates" + str(dataset_id) + ".mat")
+
+    def __repr__(self) -> str:
+        return f"GroundTruthStore[dataset={self.dataset_id}, loaded={list(self.fields.keys())}]"
@@ -0,0 +1,60 @@
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from DataTypes.measurement import MeasurementType, decode_camera_image
+
+
+class ParallelImageDecoder:
+    """Decodes the camera frames of a measurement stream in a process pool.
+
+    The compressed payloads are sent to the workers as soon as they are read, while the
+    measurements are delivered in the order of the stream with the decoded frame attached.
+    At most frames_in_flight frames are decoded ahead of the measurement being delivered.
+    The workers are spawned rather than forked, as decode is usually run on the prefetch
+    thread and forking a multithreaded process can deadlock.
+    """
+
+    def __init__(self, workers=4, frames_in_flight=None) -> None:
+        self.workers = workers
+        self.frames_in_flight = frames_in_flight if frames_in_flight is not None else 2 * workers
+        self.executor = None
+        self.start()
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def decode(self, measurements):
+        self.start()
+
+        pending = deque()
+        frames = 0
+        for measurement in measurements:
+            if measurement.measurement_type == MeasurementType.CAMERA and measurement.data is not None:
+                future = self.executor.submit(decode_camera_image, measurement.data, measurement.grayscale, measurement.reduction)
+                pending.append((measurement, future))
+                frames += 1
+            else:
+                pending.append((measurement, None))
+
+            # The head of the stream is delivered once its frame is decoded, or when too many frames are in flight
+            while pending and (pending[0][1] is None or pending[0][1].done() or frames >= self.frames_in_flight):
+                measurement, future = pending.popleft()
+                if future is not None:
+                    measurement.image = future.result()
+                    frames -= 1
+                yield measurement
+
+        while pending:
+            measurement, future = pending.popleft()
+            if future is not None:
+                measurement.image = future.result()
+            yield measurement
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __repr__(self) -> str:
+        return f"ParallelImageDecoder[workers={self.workers}, frames_in_flight={self.frames_in_flight}]"
@@ -0,0 +1,209 @@
+import json
+from pathlib import Path
+import numpy as np
+import rospy
+from DataTypes.measurement import Measurement, MeasurementType, IMU_Measurement, UWB_Measurement, GNSS_Measurement, IMUBlock
+
+"""
+Columnar cache of the rosbag measurements.
+
+Each topic of a dataset window is written once as one .npy file per column,
+which is later opened memory mapped instead of deserializing the rosbag.
+"""
+
+# Seconds before the bag start time that are cached for the GNSS pre-initialization
+PREINITIALIZATION_TIME = 10
+
+CACHED_TOPICS = ["/sentiboard/adis", "/os1_cloud_node/imu", "/uwb_beacons_parsed", "/ublox2/fix"]
+
+COLUMNS = {
+    MeasurementType.IMU: ["linear_acceleration", "angular_velocity"],
+    MeasurementType.UWB: ["src", "dist"],
+    MeasurementType.GNSS: ["latitude", "longitude", "altitude"],
+}
+
+
+def time_to_nsec(t):
+    return t.secs * 1000000000 + t.nsecs
+
+
+def nsec_to_time(nsec):
+    return rospy.Time(nsec // 1000000000, nsec % 1000000000)
+
+
+def topic_directory_name(topic):
+    return topic.strip("/").replace("/", "_")
+
+
+def extract_columns(measurement_type, msg):
+    if measurement_type == MeasurementType.IMU:
+        return (
+            [msg.linear_acceleration.x, msg.linear_acceleration.y, msg.linear_acceleration.z],
+            [msg.angular_velocity.x, msg.angular_velocity.y, msg.angular_velocity.z]
+        )
+    elif measurement_type == MeasurementType.UWB:
+        return msg.SRC, msg.Dist
+    elif measurement_type == MeasurementType.GNSS:
+        return msg.latitude, msg.longitude, msg.altitude
+    else:
+        raise NotImplementedError
+
+
+class MeasurementCache:
+
+    def __init__(self, dataset_settings) -> None:
+        self.dataset_settings = dataset_settings
+        self.directory = MeasurementCache.cache_directory(dataset_settings)
+
+        with open(Path.joinpath(self.directory, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+        self.bag_start_time = self.meta["bag_start_time"]
+        self.bag_end_time = self.meta["bag_end_time"]
+
+        # The columns are memory mapped, so only the rows that are streamed are read from disk
+        self.columns = {}
+        for topic in self.meta["topics"]:
+            topic_directory = Path.joinpath(self.directory, topic_directory_name(topic))
+            measurement_type = Measurement.select_measurement_type(topic)
+            self.columns[topic] = {
+                name: np.load(Path.joinpath(topic_directory, name + ".npy"), mmap_mode="r")
+                for name in ["time"] + COLUMNS[measurement_type]
+            }
+
+    def rows_between(self, topic, start_time, end_time):
+        """Row range of the topic within [start_time, end_time], given in nanoseconds"""
+        time = self.columns[topic]["time"]
+        return np.searchsorted(time, start_time, side="left"), np.searchsorted(time, end_time, side="right")
+
+    def merged_rows(self, topics, start_time, end_time):
+        """Columns of the topics in [start_time, end_time] (rospy.Time) and the (topic, row) pairs in time order"""
+        start_time, end_time = time_to_nsec(start_time), time_to_nsec(end_time)
+
+        blocks = []
+        for topic in topics:
+            if topic not in self.columns:
+                raise ValueError(f"Topic {topic} is not in the measurement cache, cached topics are {list(self.columns)}")
+            first, last = self.rows_between(topic, start_time, end_time)
+            # Copy the window out of the memory map, the rows are then read at memory bandwidth
+            columns = {name: np.array(column[first:last]) for name, column in self.columns[topic].items()}
+            blocks.append((topic, columns))
+
+        if not blocks:
+            return blocks, np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+        # A stable sort keeps the topic order for measurements with equal time stamps
+        times = np.concatenate([columns["time"] for _, columns in blocks])
+        topic_index = np.concatenate([np.full(len(columns["time"]), index) for index, (_, columns) in enumerate(blocks)])
+        row_index = np.concatenate([np.arange(len(columns["time"])) for _, columns in blocks])
+        order = np.argsort(times, kind="stable")
+        return blocks, topic_index[order], row_index[order]
+
+    def generate_measurements(self, topics, start_time, end_time):
+        """Yields the measurements of the topics in [start_time, end_time] (rospy.Time) in time order"""
+        blocks, topic_index, row_index = self.merged_rows(topics, start_time, end_time)
+
+        factories = [MeasurementCache.row_factory(topic, columns) for topic, columns in blocks]
+        for index, row in zip(topic_index.tolist(), row_index.tolist()):
+            yield factories[index](row)
+
+    def generate_measurement_blocks(self, topics, start_time, end_time):
+        """Same as generate_measurements, but the IMU rows between two other measurements are yielded as one IMUBlock"""
+        blocks, topic_index, row_index = self.merged_rows(topics, start_time, end_time)
+
+        imu_indices = [index for index, (topic, _) in enumerate(blocks) if Measurement.select_measurement_type(topic) == MeasurementType.IMU]
+        if len(imu_indices) > 1:
+            raise NotImplementedError("IMU blocks are only supported for a single IMU topic")
+        imu_index = imu_indices[0] if imu_indices else -1
+
+        factories = [MeasurementCache.row_factory(topic, columns) for topic, columns in blocks]
+        event_positions = np.flatnonzero(topic_index != imu_index).tolist() + [len(topic_index)]
+
+        start = 0
+        for position in event_positions:
+            if position > start:
+                # The IMU rows between two events are consecutive rows of the IMU columns
+                columns = blocks[imu_index][1]
+                first, last = row_index[start], row_index[position - 1] + 1
+                yield IMUBlock.from_columns(
+                    columns["time"][first:last] / 1e9,
+                    columns["linear_acceleration"][first:last],
+                    columns["angular_velocity"][first:last]
+                )
+            if position < len(topic_index):
+                yield factories[topic_index[position]](row_index[position])
+            start = position + 1
+
+    @staticmethod
+    def row_factory(topic, columns):
+        """Returns a function creating the measurement of a row of the topic columns"""
+        time = columns["time"].tolist()
+        measurement_type = Measurement.select_measurement_type(topic)
+
+        if measurement_type == MeasurementType.IMU:
+            linear_acceleration = columns["linear_acceleration"]
+            angular_velocity = columns["angular_velocity"]
+            return lambda i: IMU_Measurement.from_columns(topic, linear_acceleration[i], angular_velocity[i], nsec_to_time(time[i]))
+        elif measurement_type == MeasurementType.UWB:
+            src = columns["src"].tolist()
+            dist = columns["dist"].tolist()
+            return lambda i: UWB_Measurement.from_columns(topic, src[i], dist[i], nsec_to_time(time[i]))
+        elif measurement_type == MeasurementType.GNSS:
+            # All fixes of the window are converted to NED in one vectorized call
+            ned = GNSS_Measurement.NED_FRAME.geodetic_to_ned(columns["latitude"], columns["longitude"], columns["altitude"])
+            return lambda i: GNSS_Measurement.from_ned(topic, ned[i], nsec_to_time(time[i]))
+        else:
+            raise NotImplementedError
+
+    @staticmethod
+    def cache_directory(dataset_settings):
+        return Path.joinpath(
+            Path(__file__).parent.absolute(),
+            "Cache",
+            f"trondheim{dataset_settings.dataset_number}_{dataset_settings.bag_start_time_offset}_{dataset_settings.bag_duration}"
+        )
+
+    @staticmethod
+    def exists(dataset_settings):
+        return Path.joinpath(MeasurementCache.cache_directory(dataset_settings), "meta.json").exists()
+
+    @staticmethod
+    def build(dataset_settings, bag):
+        """One-time extraction of the cached topics of the dataset window into columnar .npy files"""
+        print("Building measurement cache for", dataset_settings)
+        directory = MeasurementCache.cache_directory(dataset_settings)
+
+        bag_topics = bag.get_type_and_topic_info().topics
+        topics = [topic for topic in CACHED_TOPICS if topic in bag_topics]
+
+        start_time = rospy.Time(bag.get_start_time() + dataset_settings.bag_start_time_offset - PREINITIALIZATION_TIME)
+        if dataset_settings.bag_duration < 0:
+            end_time = rospy.Time(bag.get_end_time())
+        else:
+            end_time = rospy.Time(bag.get_start_time() + dataset_settings.bag_start_time_offset + dataset_settings.bag_duration)
+
+        measurement_types = {topic: Measurement.select_measurement_type(topic) for topic in topics}
+        rows = {topic: {name: [] for name in ["time"] + COLUMNS[measurement_types[topic]]} for topic in topics}
+        for topic, msg, t in bag.read_messages(topics=topics, start_time=start_time, end_time=end_time):
+            columns = rows[topic]
+            columns["time"].append(time_to_nsec(t))
+            for name, value in zip(COLUMNS[measurement_types[topic]], extract_columns(measurement_types[topic], msg)):
+                columns[name].append(value)
+
+        for topic, columns in rows.items():
+            topic_directory = Path.joinpath(directory, topic_directory_name(topic))
+            topic_directory.mkdir(parents=True, exist_ok=True)
+            for name, values in columns.items():
+                dtype = np.int64 if name in ["time", "src"] else np.float64
+                np.save(Path.joinpath(topic_directory, name + ".npy"), np.array(values, dtype=dtype))
+
+        # The meta file is written last and marks the cache as complete
+        meta = {
+            "dataset_number": dataset_settings.dataset_number,
+            "bag_start_time": bag.get_start_time(),
+            "bag_end_time": bag.get_end_time(),
+            "start_time": time_to_nsec(start_time),
+            "end_time": time_to_nsec(end_time),
+            "topics": topics,
+        }
+        with open(Path.joinpath(directory, "meta.json"), "w") as meta_file:
+            json.dump(meta, meta_file, indent=4)
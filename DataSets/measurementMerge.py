@@ -0,0 +1,44 @@
+import heapq
+from DataTypes.measurement import MeasurementType
+
+
+def measurement_time(measurement):
+    """Time of a measurement in seconds, for both rospy.Time and float time stamps.
+
+    An IMUBlock is ordered by its first sample.
+    """
+    time = measurement.time
+    if measurement.measurement_type == MeasurementType.IMU_BLOCK:
+        return float(time[0])
+    if hasattr(time, "to_time"):
+        return time.to_time()
+    return float(time)
+
+
+def merge_measurements(*sources, key=measurement_time):
+    """Interleaves any number of time sorted measurement sources by time.
+
+    The sources can be any iterables (bag topics, .mat derived fixes, ground truth,
+    synthetic streams). Only the next measurement of each source is kept in the heap,
+    so no source is materialized. Measurements with equal time are delivered in the
+    order the sources are given.
+    """
+    iterators = [iter(source) for source in sources]
+
+    heap = []
+    for index, iterator in enumerate(iterators):
+        for measurement in iterator:
+            heap.append((key(measurement), index, measurement))
+            break
+    heapq.heapify(heap)
+
+    while heap:
+        _, index, measurement = heap[0]
+        yield measurement
+
+        # Replace the delivered measurement with the next one from the same source
+        for next_measurement in iterators[index]:
+            heapq.heapreplace(heap, (key(next_measurement), index, next_measurement))
+            break
+        else:
+            heapq.heappop(heap)
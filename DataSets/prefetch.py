@@ -0,0 +1,100 @@
+import queue
+import threading
+
+
+class _ProducerError:
+    def __init__(self, error) -> None:
+        self.error = error
+
+
+class Prefetcher:
+    """Reads a measurement generator on a producer thread into a bounded queue.
+
+    The measurements are delivered in the order of the generator. consumer_stalls counts how
+    often the fusion loop had to wait for the reader (reading is the bottleneck), producer_stalls
+    how often the reader had to wait for a full queue (optimizing is the bottleneck).
+    """
+
+    _END = object()
+
+    def __init__(self, measurements, queue_size=256, prepare=None) -> None:
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.queue_size = queue_size
+        self.prepare = prepare
+
+        # Statistics
+        self.consumer_stalls = 0
+        self.producer_stalls = 0
+        self.max_depth = 0
+        self.depth_sum = 0
+        self.count = 0
+
+        self._finished = False
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._produce, args=(measurements,), daemon=True)
+        self.thread.start()
+
+    def _produce(self, measurements):
+        try:
+            for measurement in measurements:
+                if self.prepare is not None:
+                    self.prepare(measurement)
+                if not self._put(measurement):
+                    return
+            self._put(Prefetcher._END)
+        except BaseException as error:
+            self._put(_ProducerError(error))
+
+    def _put(self, item):
+        if self.queue.full():
+            self.producer_stalls += 1
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+
+        depth = self.queue.qsize()
+        if depth == 0:
+            self.consumer_stalls += 1
+        self.max_depth = max(self.max_depth, depth)
+        self.depth_sum += depth
+
+        item = self.queue.get()
+        if item is Prefetcher._END:
+            self._finished = True
+            raise StopIteration
+        if isinstance(item, _ProducerError):
+            self._finished = True
+            raise item.error
+        self.count += 1
+        return item
+
+    def close(self):
+        """Stops the producer thread, e.g. when the fusion loop breaks out early"""
+        self._finished = True
+        self._stop.set()
+        self.thread.join()
+
+    def statistics(self):
+        return {
+            "measurements": self.count,
+            "queue_size": self.queue_size,
+            "mean_depth": self.depth_sum / max(self.count, 1),
+            "max_depth": self.max_depth,
+            "consumer_stalls": self.consumer_stalls,
+            "producer_stalls": self.producer_stalls,
+        }
+
+    def __repr__(self) -> str:
+        statistics = ", ".join(f"{key}={value}" for key, value in self.statistics().items())
+        return f"Prefetcher[{statistics}]"
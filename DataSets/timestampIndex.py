@@ -0,0 +1,99 @@
+from pathlib import Path
+import numpy as np
+from .measurementCache import time_to_nsec, nsec_to_time, topic_directory_name
+
+
+def index_times(bag, topic):
+    """
+    Time stamps (ns) of the messages of a topic.
+
+    The entries are taken from the connection indexes of the bag through the private
+    Bag._get_connections and Bag._get_entries of rosbag, which do not read the messages.
+    This is the only use of private rosbag API in the repository. If it is not there the
+    public read_messages(raw=True) is used instead, which reads every message of the topic.
+    """
+    if hasattr(bag, "_get_entries") and hasattr(bag, "_get_connections"):
+        return [time_to_nsec(entry.time) for entry in bag._get_entries(bag._get_connections(topics=[topic]))]
+    return [time_to_nsec(t) for _, _, t in bag.read_messages(topics=[topic], raw=True)]
+
+
+class TimestampIndex:
+    """Sorted per-topic time stamps of a rosbag, persisted next to the dataset.
+
+    The index is built once from the connection indexes of the bag, which does not read
+    any messages. The start and end time of the bag and the first GNSS fix after t are
+    then found without opening the messages, the latter by a binary search. The index is
+    rebuilt when the size or the modification time of the bag file changes.
+    """
+
+    def __init__(self, bag_start_time, bag_end_time, times, bag_stat=(0, 0)) -> None:
+        self.bag_start_time = bag_start_time
+        self.bag_end_time = bag_end_time
+        self.times = times
+        # Size and modification time (ns) of the indexed bag file
+        self.bag_stat = tuple(bag_stat)
+
+    @property
+    def topics(self):
+        return list(self.times.keys())
+
+    def first_after(self, topic, t):
+        """Time stamp of the first message of the topic at or after t, None if there is none"""
+        times = self.times[topic]
+        row = np.searchsorted(times, time_to_nsec(t), side="left")
+        if row == len(times):
+            return None
+        return nsec_to_time(int(times[row]))
+
+    @staticmethod
+    def index_filepath(dataset_settings):
+        return Path(dataset_settings.filepath).with_suffix(".index.npz")
+
+    @staticmethod
+    def bag_file_stat(filepath):
+        stat = Path(filepath).stat()
+        return stat.st_size, stat.st_mtime_ns
+
+    @classmethod
+    def load_or_build(cls, dataset_settings, bag):
+        filepath = TimestampIndex.index_filepath(dataset_settings)
+        bag_stat = TimestampIndex.bag_file_stat(dataset_settings.filepath)
+        if filepath.exists():
+            index = cls.load(filepath)
+            if index.bag_stat == bag_stat:
+                return index
+            print("The bag has changed since the timestamp index was built")
+        index = cls.build(bag)
+        index.bag_stat = bag_stat
+        index.save(filepath)
+        return index
+
+    @classmethod
+    def build(cls, bag):
+        print("Building timestamp index of", bag.filename)
+        times = {topic: np.array(index_times(bag, topic), dtype=np.int64) for topic in bag.get_type_and_topic_info().topics}
+        return cls(bag.get_start_time(), bag.get_end_time(), times)
+
+    def save(self, filepath):
+        arrays = {
+            "bag_time": np.array([self.bag_start_time, self.bag_end_time]),
+            "bag_stat": np.array(self.bag_stat, dtype=np.int64),
+            "topics": np.array(self.topics),
+        }
+        for topic in self.topics:
+            name = topic_directory_name(topic)
+            arrays["time_" + name] = self.times[topic]
+        np.savez(filepath, **arrays)
+
+    @classmethod
+    def load(cls, filepath):
+        data = np.load(filepath)
+        times = {topic: data["time_" + topic_directory_name(topic)] for topic in data["topics"].tolist()}
+        bag_start_time, bag_end_time = data["bag_time"].tolist()
+        # Indexes saved before the bag stat was stored are rebuilt
+        bag_stat = tuple(data["bag_stat"].tolist()) if "bag_stat" in data.files else (0, 0)
+        return cls(bag_start_time, bag_end_time, times, bag_stat)
+
+    def __repr__(self) -> str:
+        counts = ", ".join(f"{topic}={len(times)}" for topic, times in self.times.items())
+        return f"TimestampIndex[{counts}]"
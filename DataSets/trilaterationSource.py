@@ -0,0 +1,67 @@
+from pathlib import Path
+import numpy as np
+import scipy.io
+from DataTypes.measurement import UWB_Trilateration_Measurement
+
+"""
+Array backed source of the UWB trilateration fixes.
+
+The x, y, z and time columns of trilateration_3d.mat are extracted once into a
+.npy file which is memory mapped on later runs, so the start-up does not scale
+with the size of the .mat file.
+"""
+
+
+class TrilaterationSource:
+
+    TOPIC = "uwb_trilateration"
+
+    def __init__(self, dataset_settings) -> None:
+        self.dataset_settings = dataset_settings
+        filepath = TrilaterationSource.cache_filepath(dataset_settings)
+        if not filepath.exists():
+            TrilaterationSource.build(dataset_settings, filepath)
+
+        # Columns x, y, z and time, sorted by time
+        columns = np.load(filepath, mmap_mode="r")
+        self.x = columns[0]
+        self.y = columns[1]
+        self.z = columns[2]
+        self.time = columns[3]
+
+    def __len__(self):
+        return len(self.time)
+
+    def start_index(self, start_time):
+        """Index of the first fix at or after start_time (seconds)"""
+        return int(np.searchsorted(self.time, start_time, side="left"))
+
+    def generate_measurements(self, start_time=None):
+        first = 0 if start_time is None else self.start_index(start_time)
+        x = np.array(self.x[first:]).tolist()
+        y = np.array(self.y[first:]).tolist()
+        z = np.array(self.z[first:]).tolist()
+        time = np.array(self.time[first:]).tolist()
+        for i in range(len(time)):
+            yield UWB_Trilateration_Measurement.from_columns(TrilaterationSource.TOPIC, x[i], y[i], z[i], time[i])
+
+    @staticmethod
+    def cache_filepath(dataset_settings):
+        return Path.joinpath(Path(__file__).parent.absolute(), "Cache", f"trilateration{dataset_settings.dataset_number}.npy")
+
+    @staticmethod
+    def build(dataset_settings, filepath):
+        trilateration_data = scipy.io.loadmat(dataset_settings.trilateration_filepath())
+        x_list = trilateration_data["pos_sensor"][0][0][0][0]
+        y_list = trilateration_data["pos_sensor"][0][0][1][0]
+        z_list = trilateration_data["pos_sensor"][0][0][4][0]
+        time_list = trilateration_data["pos_sensor"][0][0][6][0]
+
+        columns = np.array([x_list, y_list, z_list, time_list], dtype=np.float64)
+        columns = columns[:, np.argsort(columns[3], kind="stable")]
+
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        np.save(filepath, columns)
+
+    def __repr__(self) -> str:
+        return f"TrilaterationSource[dataset={self.dataset_settings.dataset_number}, fixes={len(self)}]"
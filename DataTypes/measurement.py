@@ -1,8 +1,9 @@
 from enum import Enum
+import io
 import numpy as np
 import gtsam
-import pymap3d as pm
-from PIL import ImageFile
+from PIL import Image
+from Utils.ned_frame import NEDFrame
 
 
 UWB_OFFSET = 0.85
@@ -15,6 +16,7 @@ class MeasurementType(Enum):
     UWB = "UWB"
     UWB_TRI = "UWB_Tri"
     CAMERA = "Camera"
+    IMU_BLOCK = "IMU_Block"
 
 
 class Measurement:
@@ -53,10 +55,21 @@ class UWB_Measurement(Measurement):
         super().__init__(topic, t)
         self.extract_measurement_data(msg)
 
+    @classmethod
+    def from_columns(cls, topic, src, dist, t):
+        """Create the measurement from columnar values instead of a ROS message"""
+        measurement = cls.__new__(cls)
+        Measurement.__init__(measurement, topic, t)
+        measurement.set_measurement_data(src, dist)
+        return measurement
+
     def extract_measurement_data(self, msg):
-        self.range = msg.Dist - UWB_OFFSET
+        self.set_measurement_data(msg.SRC, msg.Dist)
+
+    def set_measurement_data(self, src, dist):
+        self.range = dist - UWB_OFFSET
         self.std = UWB_STD
-        self.id = msg.SRC
+        self.id = src
 
     def __repr__(self) -> str:
         return f"Measurement[Type={self.measurement_type.value}, Time={self.time}, Range={self.range}, Id={self.id}]"
@@ -76,15 +89,27 @@ class IMU_Measurement(Measurement):
         super().__init__(topic, t)
         self.extract_measurement_data(msg)
 
+    @classmethod
+    def from_columns(cls, topic, linear_acceleration, angular_velocity, t):
+        """Create the measurement from columnar values (IMU frame) instead of a ROS message"""
+        measurement = cls.__new__(cls)
+        Measurement.__init__(measurement, topic, t)
+        measurement.set_measurement_data(linear_acceleration, angular_velocity)
+        return measurement
+
     def imu_to_body(self, data):
         return self.R_IMU_BODY @ data
 
     def extract_measurement_data(self, msg):
+        self.set_measurement_data(
+            [msg.linear_acceleration.x, msg.linear_acceleration.y, msg.linear_acceleration.z],
+            [msg.angular_velocity.x, msg.angular_velocity.y, msg.angular_velocity.z]
+        )
+
+    def set_measurement_data(self, linear_acceleration, angular_velocity):
         # Data converted to body
-        self.angular_vel = np.array([msg.angular_velocity.y, msg.angular_velocity.x, -msg.angular_velocity.z])
-        self.angular_vel_covariance = np.diag([msg.angular_velocity_covariance[4], msg.angular_velocity_covariance[0], msg.angular_velocity_covariance[8]])
-        self.linear_vel = np.array([msg.linear_acceleration.y, msg.linear_acceleration.x, -msg.linear_acceleration.z])
-        self.linear_vel_covariance = np.diag([msg.linear_acceleration_covariance[4], msg.linear_acceleration_covariance[0], msg.linear_acceleration_covariance[8]])
+        self.angular_vel = np.array([angular_velocity[1], angular_velocity[0], -angular_velocity[2]])
+        self.linear_vel = np.array([linear_acceleration[1], linear_acceleration[0], -linear_acceleration[2]])
         self.linear_vel_covariance = np.diag([0.1, 0.1, 0.001])
         self.angular_vel_covariance = np.diag([0.00175, 0.00175, 0.001])
 
@@ -95,45 +120,126 @@ class IMU_Measurement(Measurement):
         return f"Measurement[Type={self.measurement_type.value}, Time={self.time}, Angular_vel={self.angular_vel}, Linear_vel={self.linear_vel}]"
 
 
+class IMUBlock:
+    """IMU samples between two other measurements stored as contiguous arrays.
+
+    time holds the N time stamps in seconds, linear_vel and angular_vel
+    are Nx3 arrays given in body frame (same convention as IMU_Measurement).
+    """
+
+    def __init__(self, time, linear_vel, angular_vel) -> None:
+        self.measurement_type = MeasurementType.IMU_BLOCK
+        self.time = time
+        self.linear_vel = linear_vel
+        self.angular_vel = angular_vel
+
+    @classmethod
+    def from_columns(cls, time, linear_acceleration, angular_velocity):
+        """Create the block from Nx3 columns given in IMU frame"""
+        R_IMU_BODY = IMU_Measurement.R_IMU_BODY
+        return cls(
+            np.asarray(time, dtype=float),
+            np.asarray(linear_acceleration, dtype=float).reshape(-1, 3) @ R_IMU_BODY.T,
+            np.asarray(angular_velocity, dtype=float).reshape(-1, 3) @ R_IMU_BODY.T
+        )
+
+    @classmethod
+    def concatenate(cls, blocks):
+        if len(blocks) == 1:
+            return blocks[0]
+        return cls(
+            np.concatenate([block.time for block in blocks]),
+            np.concatenate([block.linear_vel for block in blocks]),
+            np.concatenate([block.angular_vel for block in blocks])
+        )
+
+    def __len__(self):
+        return len(self.time)
+
+    def __repr__(self) -> str:
+        return f"IMUBlock[Samples={len(self)}, Start={self.time[0] if len(self) else None}, End={self.time[-1] if len(self) else None}]"
+
+
+def decode_camera_image(data, grayscale=False, reduction=1):
+    """Decode a compressed camera frame to a numpy array and mask out the hull of the vessel.
+
+    The JPEG decoder scales the frame by 1/reduction (1, 2, 4 or 8) and converts it to
+    grayscale while decoding. Color frames are returned in BGR order.
+    """
+    image = Image.open(io.BytesIO(data))
+    full_width, full_height = image.size
+    size = (full_width // reduction, full_height // reduction)
+    mode = "L" if grayscale else "RGB"
+    image.draft(mode, size)
+    if image.size != size:
+        image = image.resize(size)
+    image = np.array(image.convert(mode))
+
+    height = image.shape[0]
+    image[height - 350 // reduction:height, 150 // reduction:600 // reduction] = 0
+    if grayscale:
+        return image
+    return image[:, :, ::-1]
+
+
 class Camera_Measurement(Measurement):
 
-    def __init__(self, topic, msg, t) -> None:
+    def __init__(self, topic, msg, t, grayscale=False, reduction=1) -> None:
         super().__init__(topic, t)
+        # Decoding options, note that a reduced resolution requires scaled camera intrinsics
+        self.grayscale = grayscale
+        self.reduction = reduction
         self.extract_measurement(msg)
 
-    def _img_from_CompressedImage(self, msg):
-        """Convert compressed camera image to numpy array"""
-        parser = ImageFile.Parser()
-        parser.feed(msg.data)
-        res = parser.close()
-        return np.array(res)
-
     def extract_measurement(self, msg):
+        # The frame is not decoded before the image is accessed
         self.format = msg.format
-        self.image = self._img_from_CompressedImage(msg)
-        height, _, _ = self.image.shape
+        self.data = msg.data
+        self._image = None
 
-        self.image[height-350:height, 150:600] = [0, 0, 0]
-        self.image = self.image[:, :, ::-1]
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = decode_camera_image(self.data, self.grayscale, self.reduction)
+            self.data = None
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+        self.data = None
 
 
 class UWB_Trilateration_Measurement(Measurement):
 
+    covX = 1
+    covY = 1
+    covZ = 9
+
+    # The noise model is the same for all fixes, so it is shared
+    covariance = np.diag([covX, covY, covZ])
+    noise_model = gtsam.noiseModel.Diagonal.Precisions(np.array([0.0, 0.0, 0.0, 1.0 / covX ** 2, 1.0 / covY ** 2, 1.0 / covZ ** 2]))
+
     def __init__(self, topic, msg, t) -> None:
         super().__init__(topic, t)
         self.extract_measurement(msg)
 
+    @classmethod
+    def from_columns(cls, topic, x, y, z, t):
+        """Create the measurement from columnar values instead of a dictionary"""
+        measurement = cls.__new__(cls)
+        Measurement.__init__(measurement, topic, t)
+        measurement.set_position(x, y, z)
+        return measurement
+
     def extract_measurement(self, msg):
-        self.x = msg["x"]
-        self.y = msg["y"]
-        self.z = msg["z"]
-        self.covX = 1
-        self.covY = 1
-        self.covZ = 9
+        self.set_position(msg["x"], msg["y"], msg["z"])
 
+    def set_position(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
         self.position = [self.x, self.y, self.z]
-        self.covariance = np.diag([self.covX, self.covY, self.covZ])
-        self.noise_model = gtsam.noiseModel.Diagonal.Precisions(np.array([0.0, 0.0, 0.0, 1.0 / self.covX ** 2, 1.0 / self.covY ** 2, 1.0 / self.covZ ** 2]))
 
     def __repr__(self) -> str:
         return f"Measurement[Type={self.measurement_type.value}, Time={self.time}, X={self.x}, Y={self.y}, Z={self.z}]"
@@ -141,28 +247,40 @@ class UWB_Trilateration_Measurement(Measurement):
 
 class GNSS_Measurement(Measurement):
 
+    # NED frame of the GNSS fixes, the origin is only set up once
+    NED_FRAME = NEDFrame(63.43888731, 10.39601287, 41.59585029)
+
+    #noise_model = gtsam.noiseModel.Diagonal.Sigmas(np.array([1e-5, 1e-5, 1e-1, 1e-2, 1e-2, 1e-5]))
+    noise_model = gtsam.noiseModel.Diagonal.Precisions(np.array([0.0, 0.0, 0.0, 1e-8, 1e-8, 1e-8]))
+
     def __init__(self, topic, msg, t) -> None:
         super().__init__(topic, t)
         self.extract_measurement(msg)
 
-    def convert_GNSS_to_NED(self, msg):
-        ned_origin = [63.43888731, 10.39601287, 41.59585029]
-        n, e, d = pm.geodetic2ned(
-            msg.latitude,
-            msg.longitude,
-            msg.altitude,
-            ned_origin[0],  # NED origin
-            ned_origin[1],  # NED origin
-            ned_origin[2],  # NED origin
-            ell=pm.Ellipsoid("wgs84"),
-            deg=True,
-        )
-        #print("NED Origin",np.array([n, e, d]))
-        return np.array([n, e, d])
+    @classmethod
+    def from_columns(cls, topic, latitude, longitude, altitude, t):
+        """Create the measurement from columnar values instead of a ROS message"""
+        return cls.from_ned(topic, cls.NED_FRAME.geodetic_to_ned(latitude, longitude, altitude), t)
+
+    @classmethod
+    def from_ned(cls, topic, ned_data, t):
+        """Create the measurement from a fix already converted to NED"""
+        measurement = cls.__new__(cls)
+        Measurement.__init__(measurement, topic, t)
+        measurement.set_position(ned_data)
+        return measurement
+
+    def convert_GNSS_to_NED(self, latitude, longitude, altitude):
+        return self.NED_FRAME.geodetic_to_ned(latitude, longitude, altitude)
 
     def extract_measurement(self, msg):
+        self.set_measurement_data(msg.latitude, msg.longitude, msg.altitude)
+
+    def set_measurement_data(self, latitude, longitude, altitude):
+        self.set_position(self.convert_GNSS_to_NED(latitude, longitude, altitude))
+
+    def set_position(self, ned_data):
         # TODO: Finne ut av rekkefølgen på ting her :)
-        ned_data = self.convert_GNSS_to_NED(msg)
         self.north = ned_data[0]
         self.east = ned_data[1]
         self.down = ned_data[2]
@@ -172,14 +290,13 @@ class GNSS_Measurement(Measurement):
 
         self.position = [self.north, self.east, self.down]
         self.covariance = np.diag([self.covX, self.covY, self.covZ])
-        #self.noise_model = gtsam.noiseModel.Diagonal.Sigmas(np.array([1e-5, 1e-5, 1e-1, 1e-2, 1e-2, 1e-5]))
-        self.noise_model = gtsam.noiseModel.Diagonal.Precisions(np.array([0.0, 0.0, 0.0, 1e-8, 1e-8, 1e-8]))
 
     def __repr__(self) -> str:
         return f"Measurement[Type={self.measurement_type.value}, Time={self.time}, X={self.x}, Y={self.y}, Z={self.z}]"
 
 
-def generate_measurement(topic, msg, t):
+def generate_measurement(topic, msg, t, decode_options=None):
+    """decode_options are the grayscale and reduction keyword arguments of the camera frames"""
     measurement_type = Measurement.select_measurement_type(topic)
     if measurement_type == MeasurementType.UWB:
         return UWB_Measurement(topic, msg, t)
@@ -190,6 +307,6 @@ def generate_measurement(topic, msg, t):
     elif measurement_type == MeasurementType.GNSS:
         return GNSS_Measurement(topic, msg, t)
     elif measurement_type == MeasurementType.CAMERA:
-        return Camera_Measurement(topic, msg, t)
+        return Camera_Measurement(topic, msg, t, **(decode_options or {}))
     else:
         raise NotImplementedError
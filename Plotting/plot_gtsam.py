@@ -31,6 +31,18 @@ def interpolate_1D_arrays(value_gt, value_orb, time_gt, time_orb, resolution=100
     return f1(time_frame), f2(time_frame), time_frame - time_frame[0]
 
 
+def interpolate_ground_truth(ground_truth, estimates, time_steps, start_time, resolution=1000):
+    """
+    Ground truth [roll, pitch, yaw, north, east, down] from ground_truth.pose_at and the estimates [N x k]
+    interpolated on their common time frame. The time steps are relative to the first estimate and
+    the ground truth time to start_time, on the time base of ground_truth.time.
+    """
+    time_frame = get_common_time_frame(ground_truth.time - start_time, time_steps, resolution)
+    gt = ground_truth.pose_at(time_frame + start_time)
+    est = interp1d(time_steps, estimates, axis=0)(time_frame)
+    return gt, est, time_frame - time_frame[0]
+
+
 def plot_horizontal_trajectory(position_estimates, x_lim, y_lim, uwb_beacons, ground_truth):
     plt.suptitle("Horizontal trajectory")
     #uwb_beacons = {7782220156096217088: [-0.545153  , -0.04282936,  1.49997155], 7782220156096217089: [-92.77930304,  -6.67807677,   0.91031529], 7782220156096217090: [-22.33896783, -22.76350421,   1.49969375], 7782220156096217091: [-55.43239422,  35.36695921,  -1.19977753], 7782220156096217092: [-82.20259541,   8.18208795,   0.91097657]}
@@ -70,22 +82,10 @@ def plot_horizontal_trajectory_old(position_estimates, x_lim, y_lim, landmark_va
     plt.grid()
 
 
-def find_index_closest(time_array, start_time):
-    #temp_array = time_array - (time_array[0])
-    return (np.abs(time_array - start_time)).argmin()
-
-
 def convert_to_NED(ground_truth, position_estimates, time_steps):
-    ned_positions = []
-    for position, time in zip(position_estimates, time_steps):
-        gt_index = find_index_closest(ground_truth.time, time)
-        print("Index", gt_index, time, ground_truth.time[gt_index])
-        gt_angels = ground_truth.gt_angels[gt_index, :]
-        rotation = Rot.from_euler(
-            "xyz", [gt_angels[0], gt_angels[1], gt_angels[2]])
-        ned_positions.append(rotation.as_matrix() @ position.T)
-
-    return np.array(ned_positions)
+    gt_angels = ground_truth.pose_at(time_steps)[:, :3]
+    rotations = Rot.from_euler("xyz", gt_angels).as_matrix()
+    return np.einsum("nij,nj->ni", rotations, position_estimates)
 
 
 def plot_position(position_estimates, ground_truth, time_steps, convert_NED=False):
@@ -137,42 +137,8 @@ def plot_threedof2(position, euler_angels, ground_truth, time_steps):
     time_steps[1:] -= time_steps[1] - time_steps[0]
     time_steps -= time_steps[0] + 1
 
-    gt_time = ground_truth.time
-    #index = ground_truth.find_index_closest(ground_truth.time, 2*ground_truth.datasetSettings.gt_time_offset)
-    #gt_time = gt_time[index:]
-    gt_time -= gt_time[0]
-
-    r2d = 180/np.pi
-
-    gt, est, time = interpolate_1D_arrays(ground_truth.gt_transelation[0], position[:, 0], gt_time, time_steps)
-    print("Error North:", absoluteError(gt, est))
+    plot_threedof_estimates(position, euler_angels, ground_truth, time_steps, ground_truth.time[0])
     plt.suptitle("Pose Estimate and Ground Truth")
-    plt.subplot(311)
-    plt.plot(time, est)
-    plt.plot(time, gt)
-    plt.legend(["Estimate", "Ground truth"])
-
-    plt.grid()
-    plt.ylabel("North [m]")
-    gt, est, time = interpolate_1D_arrays(ground_truth.gt_transelation[1], position[:, 1], gt_time, time_steps)
-    print("Error East:", absoluteError(gt, est))
-
-    plt.subplot(312)
-    plt.plot(time, est)
-    plt.plot(time, gt)
-    plt.legend(["Estimate", "Ground truth"])
-    plt.grid()
-    plt.ylabel("East [m]")
-
-    gt, est, time = interpolate_1D_arrays(r2d * ground_truth.gt_angels[:, 2], r2d * euler_angels[:, 2], gt_time, time_steps)
-    print("Error Yaw:", absoluteError(gt, est))
-
-    plt.subplot(313)
-    plt.plot(time, est)
-    plt.plot(time, gt)
-    plt.legend(["Estimate", "Ground truth"])
-    plt.grid()
-    plt.ylabel("Yaw [deg]")
 
 
 def plot_threedof(position, euler_angels, ground_truth, time_steps):
@@ -180,42 +146,28 @@ def plot_threedof(position, euler_angels, ground_truth, time_steps):
     time_steps[1:] -= time_steps[1] - time_steps[0]
     time_steps -= time_steps[0]
 
-    gt_time = ground_truth.time
-    index = ground_truth.find_index_closest(ground_truth.time, 2*ground_truth.datasetSettings.gt_time_offset)
-    gt_time = gt_time[index:]
-    gt_time -= gt_time[0]
-
-    r2d = 180/np.pi
-
-    gt, est, time = interpolate_1D_arrays(ground_truth.gt_transelation[0, index:], position[:, 0], gt_time, time_steps)
-    print("Error North:", absoluteError(gt, est))
+    start_time = ground_truth.time[0] + 2*ground_truth.datasetSettings.gt_time_offset - ground_truth.time_offset
+    plot_threedof_estimates(position, euler_angels, ground_truth, time_steps, start_time)
     plt.suptitle("Pose")
-    plt.subplot(311)
-    plt.plot(time, est)
-    plt.plot(time, gt)
-    plt.legend(["Estimate", "Ground truth"])
 
-    plt.grid()
-    plt.ylabel("North [m]")
-    gt, est, time = interpolate_1D_arrays(ground_truth.gt_transelation[1, index:], position[:, 1], gt_time, time_steps)
-    print("Error East:", absoluteError(gt, est))
 
-    plt.subplot(312)
-    plt.plot(time, est)
-    plt.plot(time, gt)
-    plt.legend(["Estimate", "Ground truth"])
-    plt.grid()
-    plt.ylabel("East [m]")
+def plot_threedof_estimates(position, euler_angels, ground_truth, time_steps, start_time):
+    r2d = 180/np.pi
 
-    gt, est, time = interpolate_1D_arrays(r2d * ground_truth.gt_angels[index:, 2], r2d * euler_angels[:, 2], gt_time, time_steps)
-    print("Error Yaw:", absoluteError(gt, est))
+    estimates = np.column_stack([position[:, 0], position[:, 1], r2d * euler_angels[:, 2]])
+    gt, est, time = interpolate_ground_truth(ground_truth, estimates, time_steps, start_time)
+    gt = np.column_stack([gt[:, 3], gt[:, 4], r2d * gt[:, 2]])
+    print("Error North:", absoluteError(gt[:, 0], est[:, 0]))
+    print("Error East:", absoluteError(gt[:, 1], est[:, 1]))
+    print("Error Yaw:", absoluteError(gt[:, 2], est[:, 2]))
 
-    plt.subplot(313)
-    plt.plot(time, est)
-    plt.plot(time, gt)
-    plt.legend(["Estimate", "Ground truth"])
-    plt.grid()
-    plt.ylabel("Yaw [deg]")
+    for i, label in enumerate(["North [m]", "East [m]", "Yaw [deg]"]):
+        plt.subplot(311 + i)
+        plt.plot(time, est[:, i])
+        plt.plot(time, gt[:, i])
+        plt.legend(["Estimate", "Ground truth"])
+        plt.grid()
+        plt.ylabel(label)
 
 
 def plot_threedof_error(position, euler_angels, ground_truth, time_steps):
@@ -223,50 +175,34 @@ def plot_threedof_error(position, euler_angels, ground_truth, time_steps):
     time_steps[1:] -= time_steps[1] - time_steps[0]
     time_steps -= time_steps[0] + 1
 
-    gt_time = ground_truth.time
-    #index = ground_truth.find_index_closest(ground_truth.time, 2*ground_truth.datasetSettings.gt_time_offset)
-    #gt_time = gt_time[index:]
-    gt_time -= gt_time[0]
-
     r2d = 180/np.pi
 
-    gt, est, time = interpolate_1D_arrays(ground_truth.gt_transelation[0], position[:, 0], gt_time, time_steps)
-    gtx, estx, time = interpolate_1D_arrays(ground_truth.gt_transelation[0], position[:, 0], gt_time, time_steps)
-    gty, esty, time = interpolate_1D_arrays(ground_truth.gt_transelation[1], position[:, 1], gt_time, time_steps)
+    estimates = np.column_stack([position[:, 0], position[:, 1], r2d * euler_angels[:, 2]])
+    gt, est, time = interpolate_ground_truth(ground_truth, estimates, time_steps, ground_truth.time[0])
+    estx, esty, est_yaw = est.T
+    gtx, gty, gt_yaw = gt[:, 3], gt[:, 4], r2d * gt[:, 2]
 
-    estimate_traj = np.array([estx, esty])
-    gt_traj = np.array([gtx, gty])
-    residual_traj = gt_traj - estimate_traj
-    residual_traj = np.array([np.linalg.norm(element) for element in residual_traj.T])
-    #print("Error North:", absoluteError(gt, est))
-    est = abs(est - gt)
+    residual_traj = np.hypot(gtx - estx, gty - esty)
     plt.suptitle("Pose Error")
     plt.subplot(311)
     plt.plot(time, residual_traj)
-    #plt.plot(time, gt)
     plt.legend(["Absolute error"])
 
     plt.grid()
     plt.ylabel("Absolute error [m]")
-    #gt, est, time = interpolate_1D_arrays(ground_truth.gt_transelation[1], position[:, 1], gt_time, time_steps)
-    #print("Error East:", absoluteError(gt, est))
     estx = abs(estx - gtx)
     esty = abs(esty - gty)
 
     plt.subplot(312)
     plt.plot(time, estx)
     plt.plot(time, esty)
-    #plt.plot(time, gt)
     plt.legend(["Error in North", "Error in East"])
     plt.grid()
     plt.ylabel("Error [m]")
 
-    gt, est, time = interpolate_1D_arrays(r2d * ground_truth.gt_angels[:, 2], r2d * euler_angels[:, 2], gt_time, time_steps)
-    #print("Error Yaw:", absoluteError(gt, est))
-    est = abs(est - gt)
+    est = abs(est_yaw - gt_yaw)
     plt.subplot(313)
     plt.plot(time, est)
-    #plt.plot(time, gt)
     plt.legend(["Error in Yaw"])
     plt.grid()
     plt.ylabel("Error [deg]")
@@ -277,21 +213,9 @@ def ATE(position, ground_truth, time_steps):
     time_steps[1:] -= time_steps[1] - time_steps[0]
     time_steps -= time_steps[0] + 1
 
-    gt_time = ground_truth.time
-    #index = ground_truth.find_index_closest(ground_truth.time, 2*ground_truth.datasetSettings.gt_time_offset)
-    #gt_time = gt_time[index:]
-    gt_time -= gt_time[0]
-    gtx, estx, time = interpolate_1D_arrays(ground_truth.gt_transelation[0], position[:, 0], gt_time, time_steps)
-    gty, esty, time = interpolate_1D_arrays(ground_truth.gt_transelation[1], position[:, 1], gt_time, time_steps)
-
-    estimate_traj = np.array([estx, esty])
-    gt_traj = np.array([gtx, gty])
-
-    residual_traj = estimate_traj - gt_traj
-    sum_value = 0
-    for element in residual_traj.T:
-        sum_value += np.inner(element, element)
-    return np.sqrt(sum_value/len(residual_traj.T))
+    gt, est, time = interpolate_ground_truth(ground_truth, position[:, :2], time_steps, ground_truth.time[0])
+    residual_traj = est - gt[:, 3:5]
+    return np.sqrt(np.mean(np.sum(residual_traj**2, axis=1)))
 
 
 def new_xy_plot(position, euler_angels, ground_truth, time_steps):
@@ -299,16 +223,11 @@ def new_xy_plot(position, euler_angels, ground_truth, time_steps):
     time_steps[1:] -= time_steps[1] - time_steps[0]
     time_steps -= time_steps[0] + 1
 
-    gt_time = ground_truth.time
-    #index = ground_truth.find_index_closest(ground_truth.time, 2*ground_truth.datasetSettings.gt_time_offset)
-    #gt_time = gt_time[index:]
-    gt_time -= gt_time[0]
-    gtx, estx, time = interpolate_1D_arrays(ground_truth.gt_transelation[0], position[:, 0], gt_time, time_steps)
-    gty, esty, time = interpolate_1D_arrays(ground_truth.gt_transelation[1], position[:, 1], gt_time, time_steps)
+    gt, est, time = interpolate_ground_truth(ground_truth, position[:, :2], time_steps, ground_truth.time[0])
 
     plt.suptitle("Horizontal Trajectory")
-    plt.plot(estx, esty)
-    plt.plot(gtx, gty)
+    plt.plot(est[:, 0], est[:, 1])
+    plt.plot(gt[:, 3], gt[:, 4])
     plt.xlabel("East [m]")
     plt.ylabel("North [m]")
     plt.legend(["Estimate", "Ground truth"])
@@ -362,18 +281,19 @@ def plot_bias(bias):
 def plot_vel(velocities, time_steps, ground_truth):
     time_steps = np.array(time_steps)
     time_steps[1:] -= time_steps[1] - time_steps[0]
+    gt_velocities = ground_truth.velocity_at(time_steps)
     plt.suptitle("Velocities")
     plt.subplot(311)
     plt.plot(time_steps, velocities[:, 0])
-    plt.plot(ground_truth.time, ground_truth.v_north)
+    plt.plot(time_steps, gt_velocities[:, 0])
     plt.ylabel("North velocity")
     plt.subplot(312)
     plt.plot(time_steps, velocities[:, 1])
-    plt.plot(ground_truth.time, ground_truth.v_east)
+    plt.plot(time_steps, gt_velocities[:, 1])
 
     plt.ylabel("East velocity")
     plt.subplot(313)
     plt.plot(time_steps, velocities[:, 2])
-    plt.plot(ground_truth.time, ground_truth.v_down)
+    plt.plot(time_steps, gt_velocities[:, 2])
 
     plt.ylabel("Down velocity")
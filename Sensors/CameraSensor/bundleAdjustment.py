@@ -0,0 +1,157 @@
+from collections import deque
+import numpy as np
+from scipy.optimize import least_squares
+from scipy.sparse import lil_matrix
+from scipy.spatial.transform import Rotation as Rot
+
+
+class Keyframe:
+    """Camera orientation R and center c in the VO world frame, and the landmarks seen in the frame"""
+
+    def __init__(self, R, c) -> None:
+        self.R = R
+        self.c = np.ravel(c).astype(float)
+        # Landmark id of each feature index (keypoint or tracked point) of the frame
+        self.landmark_of_feature = {}
+        self.landmarks = []
+        self.uv = []
+
+    def observe(self, landmark, feature, uv):
+        self.landmark_of_feature[feature] = landmark
+        self.landmarks.append(landmark)
+        self.uv.append(uv[:2])
+
+
+class LocalBundleAdjustment:
+    """
+    Sliding window bundle adjustment over the last keyframes of the VO and their shared landmarks.
+
+    Landmarks are triangulated once and reused while their features keep being matched
+    or tracked. The oldest keyframe of the window is held fixed, the other keyframe poses
+    and the landmarks seen at least twice in the window are refined with least_squares,
+    using the sparsity of the reprojection Jacobian. The scale of the window is carried
+    by the initial values, as only the oldest pose is fixed.
+    """
+
+    def __init__(self, K, window=5, max_nfev=20, loss_scale=4.0) -> None:
+        self.K = K
+        self.window = window
+        self.max_nfev = max_nfev
+        # Reprojection error in pixels where the robust loss starts to down-weight an observation
+        self.loss_scale = loss_scale
+        self.keyframes = deque()
+        self.landmarks = {}
+        self.next_landmark = 0
+
+    def add_keyframe(self, R, c):
+        self.keyframes.append(Keyframe(R, c))
+        if len(self.keyframes) > self.window:
+            self.keyframes.popleft()
+            self.remove_unseen_landmarks()
+        return self.keyframes[-1]
+
+    def add_matches(self, features1, features2, uv1, uv2, X):
+        """
+        Adds the inlier matches between the two newest keyframes. features are the feature indices
+        of the matches in each frame, uv [n x 2] their pixel coordinates and X [n x 3] the world
+        position of newly triangulated landmarks. Features of the previous keyframe which already
+        have a landmark keep it.
+        """
+        previous, current = self.keyframes[-2], self.keyframes[-1]
+        for i in range(len(features1)):
+            landmark = previous.landmark_of_feature.get(features1[i])
+            if landmark is None:
+                landmark = self.next_landmark
+                self.next_landmark += 1
+                self.landmarks[landmark] = X[i]
+                previous.observe(landmark, features1[i], uv1[i])
+            current.observe(landmark, features2[i], uv2[i])
+
+    def restart(self, R, c):
+        """Drops the window and its landmarks, the window starts again from a keyframe with the orientation R and center c"""
+        self.keyframes.clear()
+        self.landmarks = {}
+        return self.add_keyframe(R, c)
+
+    def remove_unseen_landmarks(self):
+        seen = set()
+        for keyframe in self.keyframes:
+            seen.update(keyframe.landmarks)
+        self.landmarks = {landmark: X for landmark, X in self.landmarks.items() if landmark in seen}
+
+    def anchor(self, R, c):
+        """
+        Moves the window rigidly so the newest keyframe has the orientation R and center c,
+        keeps the window in the VO frame when the VO pose is reset between keyframes
+        """
+        newest = self.keyframes[-1]
+        c = np.ravel(c)
+        G = R @ newest.R.T
+        origin = newest.c
+        for keyframe in self.keyframes:
+            keyframe.R = G @ keyframe.R
+            keyframe.c = G @ (keyframe.c - origin) + c
+        for landmark in self.landmarks:
+            self.landmarks[landmark] = G @ (self.landmarks[landmark] - origin) + c
+
+    def optimize(self):
+        """Refines the window, returns the refined orientation and center of the newest keyframe"""
+        keyframes = list(self.keyframes)
+        if len(keyframes) < 2:
+            return keyframes[-1].R, keyframes[-1].c
+
+        # Observations of the landmarks seen at least twice in the window
+        frame_index = np.concatenate([np.full(len(keyframe.landmarks), k) for k, keyframe in enumerate(keyframes)])
+        landmark_ids = np.concatenate([np.array(keyframe.landmarks, dtype=int) for keyframe in keyframes])
+        uv = np.concatenate([np.reshape(keyframe.uv, (-1, 2)) for keyframe in keyframes])
+        ids, landmark_index, counts = np.unique(landmark_ids, return_inverse=True, return_counts=True)
+        used = counts[landmark_index] >= 2
+        if not np.any(used):
+            return keyframes[-1].R, keyframes[-1].c
+        ids, landmark_index = np.unique(landmark_ids[used], return_inverse=True)
+        frame_index = frame_index[used]
+        uv = uv[used]
+
+        num_poses = len(keyframes) - 1
+        x0 = np.concatenate([
+            np.concatenate([np.concatenate([Rot.from_matrix(keyframe.R).as_rotvec(), keyframe.c]) for keyframe in keyframes[1:]]),
+            np.concatenate([self.landmarks[landmark] for landmark in ids])
+        ])
+        fixed = np.concatenate([Rot.from_matrix(keyframes[0].R).as_rotvec(), keyframes[0].c])
+
+        def residuals(x):
+            poses = np.vstack([fixed, x[:6 * num_poses].reshape(-1, 6)])
+            R = Rot.from_rotvec(poses[:, :3]).as_matrix()
+            X = x[6 * num_poses:].reshape(-1, 3)
+            # Camera frame points R^T (X - c) of every observation
+            Xc = np.einsum("nji,nj->ni", R[frame_index], X[landmark_index] - poses[frame_index, 3:])
+            uvw = Xc @ self.K.T
+            return (uvw[:, :2] / uvw[:, 2:] - uv).ravel()
+
+        result = least_squares(residuals, x0, jac_sparsity=self.sparsity(frame_index, landmark_index, num_poses, len(ids)),
+                               loss="soft_l1", f_scale=self.loss_scale, max_nfev=self.max_nfev, method="trf")
+
+        poses = result.x[:6 * num_poses].reshape(-1, 6)
+        for keyframe, pose in zip(keyframes[1:], poses):
+            keyframe.R = Rot.from_rotvec(pose[:3]).as_matrix()
+            keyframe.c = pose[3:]
+        for landmark, X in zip(ids, result.x[6 * num_poses:].reshape(-1, 3)):
+            self.landmarks[landmark] = X
+        return keyframes[-1].R, keyframes[-1].c
+
+    @staticmethod
+    def sparsity(frame_index, landmark_index, num_poses, num_landmarks):
+        """Jacobian sparsity, each residual depends on the pose of its frame (unless fixed) and its landmark"""
+        A = lil_matrix((2 * len(frame_index), 6 * num_poses + 3 * num_landmarks), dtype=int)
+        rows = np.arange(len(frame_index))
+        for i in range(6):
+            free = frame_index > 0
+            A[2 * rows[free], 6 * (frame_index[free] - 1) + i] = 1
+            A[2 * rows[free] + 1, 6 * (frame_index[free] - 1) + i] = 1
+        for i in range(3):
+            A[2 * rows, 6 * num_poses + 3 * landmark_index + i] = 1
+            A[2 * rows + 1, 6 * num_poses + 3 * landmark_index + i] = 1
+        return A
+
+    def __repr__(self) -> str:
+        return f"LocalBundleAdjustment[keyframes={len(self.keyframes)}, landmarks={len(self.landmarks)}]"
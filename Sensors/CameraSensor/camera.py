@@ -4,19 +4,54 @@ import cv2
 
 class PinholeCamera:
 
-    def __init__(self) -> None:
-        self.width = 1920
-        self.height = 1200
+    def __init__(self, processing_scale=1.0) -> None:
+        # Frames are processed at processing_scale times the sensor resolution, K is scaled to match
+        self.processing_scale = processing_scale
+        self.width = int(round(1920 * processing_scale))
+        self.height = int(round(1200 * processing_scale))
         self.freq = 10
         self.K = np.array([[1995.4, 0, 965.5],
                            [0, 1995.2, 605.6],
                            [0, 0, 1]])
+        self.K[:2] *= processing_scale
         self.Kinv = np.linalg.inv(self.K)
         self.dist = np.array([-0.14964, 0.13337, 0.0, 0.0, 0.0])
 
+        # Undistortion maps and ROI for each image resolution, see undistortion_maps
+        self.undistortion_cache = {}
+
+    def scaled_K(self, width, height):
+        """Camera matrix of width x height frames, K scaled from the processing resolution"""
+        K = self.K.copy()
+        K[0] *= width / self.width
+        K[1] *= height / self.height
+        return K
+
+    def undistortion_maps(self, width, height):
+        """Remap tables and ROI of the undistortion of width x height images, computed once per resolution"""
+        if (width, height) not in self.undistortion_cache:
+            K = self.scaled_K(width, height)
+            optimalMatrix, roi = cv2.getOptimalNewCameraMatrix(K, self.dist, (width, height), 1, (width, height))
+            map1, map2 = cv2.initUndistortRectifyMap(K, self.dist, None, optimalMatrix, (width, height), cv2.CV_16SC2)
+            self.undistortion_cache[(width, height)] = (map1, map2, roi)
+        return self.undistortion_cache[(width, height)]
+
+    def decode_reduction(self):
+        """Largest JPEG decoding reduction (1, 2, 4 or 8) that does not decode below the processing scale"""
+        reduction = 1
+        while reduction < 8 and 2 * reduction * self.processing_scale <= 1:
+            reduction *= 2
+        return reduction
+
+    def resize_image(self, img):
+        """Resizes a frame to the processing resolution, frames already at that resolution are returned as is"""
+        if img.shape[:2] == (self.height, self.width):
+            return img
+        return cv2.resize(img, (self.width, self.height), interpolation=cv2.INTER_AREA)
+
     def undistort_image(self, img):
-        optimalMatrix, roi = cv2.getOptimalNewCameraMatrix(self.K, self.dist, (self.width, self.height), 1, (self.width, self.height))
-        undistorted_image = cv2.undistort(img, self.K, self.dist, None, optimalMatrix)
+        map1, map2, roi = self.undistortion_maps(img.shape[1], img.shape[0])
+        undistorted_image = cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
         x, y, w, h = roi
         return undistorted_image[y:y+h, x:x+w]
 
@@ -1,5 +1,6 @@
 from unittest import TextTestRunner
 from Sensors.CameraSensor.camera import PinholeCamera
+from Sensors.CameraSensor.bundleAdjustment import LocalBundleAdjustment
 import cv2
 import numpy as np
 from scipy.spatial.transform import Rotation as Rot
@@ -54,6 +55,67 @@ def project(K, X):
     return uvw[:2, :]
 
 
+def reprojection_jacobian(K, T, p, X):
+    """
+    Reprojection of the points X [shape 4 x n] through the pose
+    rotate_x(p[0]) @ rotate_y(p[1]) @ rotate_z(p[2]) @ translate(p[3:]) @ T
+    and the analytic Jacobian of the pixel coordinates with respect to p.
+    Returns uv_hat [shape 2 x n] and the Jacobians of u and v [each shape n x 6].
+    """
+    Y = (T@X)[:3, :] + np.reshape(p[3:], (3, 1))
+    Rx, Ry, Rz = rotate_x(p[0])[:3, :3], rotate_y(p[1])[:3, :3], rotate_z(p[2])[:3, :3]
+    Gx = np.array([[0, 0, 0], [0, 0, -1], [0, 1, 0]])
+    Gy = np.array([[0, 0, 1], [0, 0, 0], [-1, 0, 0]])
+    Gz = np.array([[0, -1, 0], [1, 0, 0], [0, 0, 0]])
+
+    # Derivatives of the camera frame points [shape 3 x n] with respect to each parameter
+    R = Rx@Ry@Rz
+    dXc = [Rx@Gx@Ry@Rz@Y, Rx@Ry@Gy@Rz@Y, R@Gz@Y,
+           np.repeat(R[:, 0:1], Y.shape[1], axis=1), np.repeat(R[:, 1:2], Y.shape[1], axis=1), np.repeat(R[:, 2:3], Y.shape[1], axis=1)]
+
+    uvw = K@(R@Y)
+    uv_hat = uvw[:2, :]/uvw[2, :]
+    Ju = np.empty((Y.shape[1], 6))
+    Jv = np.empty((Y.shape[1], 6))
+    for i, dX in enumerate(dXc):
+        duvw = K@dX
+        Ju[:, i] = (duvw[0] - uv_hat[0]*duvw[2])/uvw[2]
+        Jv[:, i] = (duvw[1] - uv_hat[1]*duvw[2])/uvw[2]
+    return uv_hat, Ju, Jv
+
+
+def levenberg_marquardt_analytic(residuals_and_jacobian, p0, num_iterations=100, mu=1e-3, step_tolerance=1e-5, cost_tolerance=1e-10):
+    """
+    Levenberg-Marquardt on a function returning the residuals and their Jacobian.
+    A step is only accepted if it lowers the cost. Stops when the step or the
+    relative decrease of the cost becomes small.
+    """
+    p = p0.copy()
+    r, J = residuals_and_jacobian(p)
+    cost = costFunc(r)
+    for iteration in range(num_iterations):
+        A = J.T @ J
+        b = - J.T @ r
+        while True:
+            delta = np.linalg.solve(A + mu*np.eye(len(p)), b)
+            r_new, J_new = residuals_and_jacobian(p + delta)
+            cost_new = costFunc(r_new)
+            if cost_new < cost or mu > 1e10:
+                break
+            mu *= 2
+
+        if cost_new >= cost:
+            break
+        mu /= 3
+        p = p + delta
+        converged = np.linalg.norm(delta) < step_tolerance or (cost - cost_new) < cost_tolerance*cost
+        r, J, cost = r_new, J_new, cost_new
+        if converged:
+            break
+
+    return p
+
+
 def levenberg_marquardt(residualsfun, p0, num_iterations=100, finite_difference_epsilon=1e-5, mu=1e-3):
     eps = finite_difference_epsilon
     p = p0.copy()
@@ -101,19 +163,13 @@ def levenberg_marquardt(residualsfun, p0, num_iterations=100, finite_difference_
 
 
 def costFunc(residuals):
-    cost = 0
-    for element in residuals:
-        cost += element**2
-    return cost
+    return np.sum(residuals**2)
 
 # Calculating the cost given the residuals and the step based on delta (sum of squares)
 
 
 def costFuncLinearization(residuals, J, delta):
-    cost = 0
-    for i in range(len(residuals)):
-        cost += (residuals[i] + J[i, :] @ delta)**2
-    return cost
+    return np.sum((residuals + J @ delta)**2)
 
 
 def getCommonImagePoints(imageIndexes, kp1, kp2):
@@ -133,35 +189,136 @@ def getCommonImagePoints(imageIndexes, kp1, kp2):
     return np.array(uv1), np.array(uv2)
 
 
+def grayscale(image):
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+
+def median_parallax(uv1, uv2):
+    """Median pixel displacement between the corresponding points uv1, uv2 [n x 3]"""
+    if len(uv1) == 0:
+        return 0.0
+    return np.median(np.linalg.norm(uv2[:, :2] - uv1[:, :2], axis=1))
+
+
 def get_num_ransac_trials(sample_size, confidence, inlier_fraction):
     return int(np.log(1 - confidence)/np.log(1 - inlier_fraction**sample_size))
 
 
-def estimate_E_ransac(xy1, xy2, K, distance_threshold, num_trials):
+def adaptive_num_ransac_trials(sample_size, confidence, inlier_fraction, max_trials):
+    """Number of trials needed for the inlier fraction found so far, at most max_trials"""
+    if inlier_fraction <= 0:
+        return max_trials
+    if inlier_fraction >= 1:
+        return 1
+    outlier_sample_probability = 1 - inlier_fraction**sample_size
+    if outlier_sample_probability <= 0:
+        return 1
+    return min(max_trials, int(np.ceil(np.log(1 - confidence)/np.log(outlier_sample_probability))))
+
+
+def estimate_E_ransac(xy1, xy2, K, distance_threshold, num_trials, batch_size=32, confidence=0.999):
+    """
+    Batched, adaptive RANSAC for the essential matrix. The 8-point estimates of a
+    batch of hypotheses are solved with one batched SVD and every hypothesis is
+    scored against every correspondence at once. After each batch the trial budget
+    is lowered to what the best inlier fraction so far needs for the confidence,
+    num_trials is the upper limit. With confidence=None all num_trials are run.
+    Returns the first hypothesis with the most inliers and its inliers.
+    """
+    uv1 = K@xy1
+    uv2 = K@xy2
+    n = xy1.shape[1]
+
+    best_num_inliers = -1
+    required_trials = num_trials
+    trials = 0
+    while trials < required_trials:
+        sample = sample_minimal_sets(n, 8, min(batch_size, required_trials - trials))
+        trials += len(sample)
+        E_batch = estimate_E(xy1[:, sample], xy2[:, sample])
+        d_batch = epipolar_distance(F_from_E(E_batch, K), uv1, uv2)
+        inliers_batch = np.absolute(d_batch) < distance_threshold
+        num_inliers_batch = np.sum(inliers_batch, axis=1)
+        best = np.argmax(num_inliers_batch)
+        if num_inliers_batch[best] > best_num_inliers:
+            best_num_inliers = num_inliers_batch[best]
+            E = E_batch[best]
+            inliers = inliers_batch[best]
+            if confidence is not None:
+                required_trials = adaptive_num_ransac_trials(8, confidence, best_num_inliers/n, num_trials)
+
+    return E, inliers
+
+
+def skew(t):
+    """Cross product matrix of t [3], or a stack of them for t [b x 3]"""
+    t = np.asarray(t)
+    S = np.zeros(t.shape[:-1] + (3, 3))
+    S[..., 0, 1], S[..., 0, 2] = -t[..., 2], t[..., 1]
+    S[..., 1, 0], S[..., 1, 2] = t[..., 2], -t[..., 0]
+    S[..., 2, 0], S[..., 2, 1] = -t[..., 1], t[..., 0]
+    return S
+
+
+def translation_constraints(xy1, xy2, R):
+    """
+    With the relative rotation R known, the epipolar constraint of each correspondence
+    becomes t . ((R xy1) x xy2) = 0. Returns the normals (R xy1) x xy2 [shape n x 3]
+    """
+    return np.cross((R@xy1).T, xy2.T)
+
+
+def estimate_t(constraints):
+    """Unit translation direction closest to orthogonal to all the constraints [n x 3]"""
+    _, _, VT = np.linalg.svd(constraints)
+    return VT[-1]
 
-    # Tip: The following snippet extracts a random subset of 8
-    # correspondences (w/o replacement) and estimates E using them.
-    #   sample = np.random.choice(xy1.shape[1], size=8, replace=False)
-    #   E = estimate_E(xy1[:,sample], xy2[:,sample])
 
+def estimate_t_ransac(xy1, xy2, R, K, distance_threshold, num_trials, batch_size=32, confidence=0.999):
+    """
+    Two-point RANSAC for the translation direction when the relative rotation R is known,
+    e.g. predicted by the IMU. The hypothesis of two correspondences is the cross product
+    of their translation constraints, batches of hypotheses are scored at once and the
+    trial budget adapts as in estimate_E_ransac.
+    Returns E = [t]x R of the first hypothesis with the most inliers and its inliers.
+    """
     uv1 = K@xy1
     uv2 = K@xy2
+    n = xy1.shape[1]
+    constraints = translation_constraints(xy1, xy2, R)
 
     best_num_inliers = -1
-    for i in range(num_trials):
-        sample = np.random.choice(xy1.shape[1], size=8, replace=False)
-        E_i = estimate_E(xy1[:, sample], xy2[:, sample])
-        d_i = epipolar_distance(F_from_E(E_i, K), uv1, uv2)
-        inliers_i = np.absolute(d_i) < distance_threshold
-        num_inliers_i = np.sum(inliers_i)
-        if num_inliers_i > best_num_inliers:
-            best_num_inliers = num_inliers_i
-            E = E_i
-            inliers = inliers_i
+    E, inliers = skew(estimate_t(constraints))@R, np.zeros(n, dtype=bool)
+    required_trials = num_trials
+    trials = 0
+    while trials < required_trials:
+        sample = sample_minimal_sets(n, 2, min(batch_size, required_trials - trials))
+        trials += len(sample)
+        t_batch = np.cross(constraints[sample[:, 0]], constraints[sample[:, 1]])
+        # Parallel constraints give no translation
+        t_batch = t_batch[np.linalg.norm(t_batch, axis=1) > 1e-12]
+        if len(t_batch) == 0:
+            continue
+        E_batch = skew(t_batch)@R
+        d_batch = epipolar_distance(F_from_E(E_batch, K), uv1, uv2)
+        inliers_batch = np.absolute(d_batch) < distance_threshold
+        num_inliers_batch = np.sum(inliers_batch, axis=1)
+        best = np.argmax(num_inliers_batch)
+        if num_inliers_batch[best] > best_num_inliers:
+            best_num_inliers = num_inliers_batch[best]
+            E = E_batch[best]
+            inliers = inliers_batch[best]
+            if confidence is not None:
+                required_trials = adaptive_num_ransac_trials(2, confidence, best_num_inliers/n, num_trials)
 
     return E, inliers
 
 
+def sample_minimal_sets(n, sample_size, num_samples):
+    """Draws num_samples random subsets of sample_size indices out of n (w/o replacement), shape [num_samples x sample_size]"""
+    return np.argpartition(np.random.random((num_samples, n)), sample_size - 1, axis=1)[:, :sample_size]
+
+
 def F_from_E(E, K):
     K_inv = np.linalg.inv(K)
     F = K_inv.T@E@K_inv
@@ -170,28 +327,55 @@ def F_from_E(E, K):
 
 def epipolar_distance(F, uv1, uv2):
     """
-    F should be the fundamental matrix (use F_from_E)
+    F should be the fundamental matrix (use F_from_E), or a stack
+    of fundamental matrices [shape b x 3 x 3]
     uv1, uv2 should be 3 x n homogeneous pixel coordinates
+    Returns the distances [shape n, or b x n for a stack of F]
     """
-    n = uv1.shape[1]
     l2 = F@uv1
-    l1 = F.T@uv2
-    e = np.sum(uv2*l2, axis=0)
-    norm1 = np.linalg.norm(l1[:2, :], axis=0)
-    norm2 = np.linalg.norm(l2[:2, :], axis=0)
+    l1 = np.swapaxes(F, -1, -2)@uv2
+    e = np.sum(uv2*l2, axis=-2)
+    norm1 = np.linalg.norm(l1[..., :2, :], axis=-2)
+    norm2 = np.linalg.norm(l2[..., :2, :], axis=-2)
     return 0.5*e*(1/norm1 + 1/norm2)
 
 
 def estimate_E(xy1, xy2):
-    n = xy1.shape[1]
-    A = np.empty((n, 9))
-    for i in range(n):
-        x1, y1 = xy1[:2, i]
-        x2, y2 = xy2[:2, i]
-        A[i, :] = [x1*x2, y1*x2, x2, x1*y2, y1*y2, y2, x1, y1, 1]
+    """
+    Eight-point estimate of E from xy1, xy2 [shape 3 x n], or of one E for each
+    set of correspondences [shape 3 x b x n, giving E of shape b x 3 x 3]
+    """
+    x1, y1 = xy1[0], xy1[1]
+    x2, y2 = xy2[0], xy2[1]
+    A = np.stack([x1*x2, y1*x2, x2, x1*y2, y1*y2, y2, x1, y1, np.ones_like(x1)], axis=-1)
 
     _, _, VT = np.linalg.svd(A)
-    return np.reshape(VT[-1, :], (3, 3))
+    return np.reshape(VT[..., -1, :], VT.shape[:-2] + (3, 3))
+
+
+def normalize_points(xy):
+    """Similarity transform moving the centroid of xy [shape 3 x n] to the origin with mean distance sqrt(2)"""
+    centroid = np.mean(xy[:2], axis=1)
+    distance = np.mean(np.linalg.norm(xy[:2] - centroid[:, None], axis=0))
+    s = np.sqrt(2)/distance if distance > 0 else 1.0
+    return np.array([[s, 0, -s*centroid[0]],
+                     [0, s, -s*centroid[1]],
+                     [0, 0, 1]])
+
+
+def estimate_E_normalized(xy1, xy2):
+    """
+    Least-squares estimate of E from all correspondences xy1, xy2 [shape 3 x n]
+    with normalized coordinates, projected to the essential manifold
+    (two equal singular values and one zero).
+    """
+    T1 = normalize_points(xy1)
+    T2 = normalize_points(xy2)
+    E = T2.T @ estimate_E(T1@xy1, T2@xy2) @ T1
+
+    U, S, VT = np.linalg.svd(E)
+    sigma = (S[0] + S[1])/2
+    return U @ np.diag([sigma, sigma, 0]) @ VT
 
 
 def triangulate_many(xy1, xy2, P1, P2):
@@ -205,17 +389,38 @@ def triangulate_many(xy1, xy2, P1, P2):
         X:  Dehomogenized 3D points in world frame
             [shape 4 x n]
     """
+    A = np.empty((xy1.shape[1], 4, 4))
+    A[:, 0, :] = P1[0, :] - xy1[0, :, None]*P1[2, :]
+    A[:, 1, :] = P1[1, :] - xy1[1, :, None]*P1[2, :]
+    A[:, 2, :] = P2[0, :] - xy2[0, :, None]*P2[2, :]
+    A[:, 3, :] = P2[1, :] - xy2[1, :, None]*P2[2, :]
+    _, _, VT = np.linalg.svd(A)
+    return (VT[:, 3, :]/VT[:, 3, 3, None]).T
+
+
+def count_visible(T, xy1, xy2):
+    """Number of points triangulated in front of both cameras for the relative pose T"""
+    P1 = np.array([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0]])
+    X1 = triangulate_many(xy1, xy2, P1, T[:3, :])
+    X2 = T@X1
+    return np.sum((X1[2, :] > 0) & (X2[2, :] > 0))
+
+
+def select_pose_by_cheirality(T4, xy1, xy2, num_samples=20):
+    """
+    Picks the candidate pose with the most points in front of both cameras.
+    The candidates are first tested on a random subset of num_samples points,
+    all points are only used if no candidate has a visible point in the subset.
+    """
     n = xy1.shape[1]
-    X = np.empty((4, n))
-    for i in range(n):
-        A = np.empty((4, 4))
-        A[0, :] = P1[0, :] - xy1[0, i]*P1[2, :]
-        A[1, :] = P1[1, :] - xy1[1, i]*P1[2, :]
-        A[2, :] = P2[0, :] - xy2[0, i]*P2[2, :]
-        A[3, :] = P2[1, :] - xy2[1, i]*P2[2, :]
-        U, s, VT = np.linalg.svd(A)
-        X[:, i] = VT[3, :]/VT[3, 3]
-    return X
+    if n > num_samples:
+        sample = np.random.choice(n, size=num_samples, replace=False)
+        num_visible = [count_visible(T, xy1[:, sample], xy2[:, sample]) for T in T4]
+        if max(num_visible) > 0:
+            return T4[int(np.argmax(num_visible))]
+
+    num_visible = [count_visible(T, xy1, xy2) for T in T4]
+    return T4[int(np.argmax(num_visible))]
 
 
 def decompose_E(E):
@@ -246,14 +451,66 @@ def SE3(R, t):
 
 class VisualOdometry:
 
-    def __init__(self, noise_values=0) -> None:
+    # Pose refinement backends, see refine_pose
+    REFINEMENTS = ["analytic", "least_squares", "finite_difference"]
+    # Tracking frontends, ORB detection and matching or pyramidal Lucas-Kanade tracking
+    FRONTENDS = ["orb", "klt"]
+    # Relative pose backends, the batched 8-point RANSAC above or OpenCV's 5-point solver
+    GEOMETRIES = ["eight_point", "five_point"]
+    # Robust method of the five-point backend, cv2.RANSAC or cv2.LMEDS
+    five_point_method = cv2.RANSAC
+
+    # KLT settings, features are re-detected when fewer than klt_min_features are still tracked
+    klt_window = (21, 21)
+    klt_levels = 3
+    klt_min_features = 100
+
+    # RANSAC inlier threshold on the epipolar distance, in pixels of the frames at the processing scale
+    ransac_threshold = 1.0
+    # RANSAC confidence, the trial budget adapts to the inlier fraction found
+    ransac_confidence = 0.999
+    # A bundle adjusted motion is replaced by the two-view motion if its rotation differs by more than
+    # ba_max_rotation_change (radians) or its translation by more than ba_max_translation_change baselines
+    ba_max_rotation_change = np.radians(2.0)
+    ba_max_translation_change = 1.5
+
+    def __init__(self, noise_values=0, refinement="analytic", visualization=None, sparse_undistortion=False, frontend="orb", processing_scale=1.0,
+                 keyframe_parallax=0.0, keyframe_rotation=0.0, keyframe_translation=0.0, geometry="eight_point",
+                 bundle_adjustment_window=0, imu_aided=False) -> None:
         self.noise_values_init = noise_values
         self.noise_values = noise_values
-        self.camera = PinholeCamera()
+        # Image resolution scale of the processed frames, not to be confused with the metric scale self.scale
+        self.camera = PinholeCamera(processing_scale)
         self.detector = cv2.ORB_create(nfeatures=250)
         self.old_image = None
+        self.old_keypoints = None
+        self.old_descriptors = None
         self.scale = 1.0
         self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING2, crossCheck=False)
+        self.refinement = refinement
+        # Optional VisualizationSink showing the tracked frames, headless if None
+        self.visualization = visualization
+        # Detect on the raw frames and undistort only the matched keypoints instead of the whole frames
+        self.sparse_undistortion = sparse_undistortion
+        self.frontend = frontend
+        self.geometry = geometry
+        # Use the IMU rotation passed to track for a two-point RANSAC on the translation only
+        self.imu_aided = imu_aided
+        self.old_gray = None
+        self.old_points = None
+
+        # Keyframe policy, frames with a median feature displacement below keyframe_parallax (pixels),
+        # or with an IMU motion since the last keyframe below both keyframe_rotation (radians) and
+        # keyframe_translation (meters), are skipped. The default thresholds make every frame a keyframe
+        self.keyframe_parallax = keyframe_parallax
+        self.keyframe_rotation = keyframe_rotation
+        self.keyframe_translation = keyframe_translation
+        self.frames_since_keyframe = 0
+        self.keyframe_motion_R = np.eye(3)
+        self.keyframe_motion_t = np.zeros(3)
+
+        # Optional local bundle adjustment over the last bundle_adjustment_window keyframes, off if below 2
+        self.bundle_adjustment = LocalBundleAdjustment(self.camera.K, bundle_adjustment_window) if bundle_adjustment_window > 1 else None
 
         # States
         self.states = []
@@ -261,26 +518,48 @@ class VisualOdometry:
 
         self.body_t_cam = Rot.from_euler('xyz', [0.823, -2.807, 8.303], degrees=True).as_matrix()  @ np.array([[0, 0, 1], [1, 0, 0], [0, 1, 0]])
 
+    def settings(self):
+        """The settings that change the estimated motions, the key of the VisualOdometryCache"""
+        return {
+            "K": self.camera.K.tolist(),
+            "dist": self.camera.dist.tolist(),
+            "processing_scale": self.camera.processing_scale,
+            "features": self.detector.getMaxFeatures(),
+            "refinement": self.refinement,
+            "sparse_undistortion": self.sparse_undistortion,
+            "frontend": self.frontend,
+            "geometry": self.geometry,
+            "keyframe_parallax": self.keyframe_parallax,
+            "keyframe_rotation": self.keyframe_rotation,
+            "keyframe_translation": self.keyframe_translation,
+            "bundle_adjustment_window": 0 if self.bundle_adjustment is None else self.bundle_adjustment.window,
+            "imu_aided": self.imu_aided,
+            "five_point_method": self.five_point_method,
+            "klt": [self.klt_window, self.klt_levels, self.klt_min_features],
+            "ransac": [self.ransac_threshold, self.ransac_confidence],
+        }
+
+    def uses_imu(self):
+        """True if the estimated motions depend on the IMU motions passed to track"""
+        return self.imu_aided or self.keyframe_rotation > 0 or self.keyframe_translation > 0
+
+    def cacheable(self):
+        """
+        True if the estimated motions only depend on the frames and the settings, so the VisualOdometryCache
+        can replay them. The bundle adjustment anchors its window at the integrated pose, which depends on
+        the resets and the scale of the fusion
+        """
+        return not self.uses_imu() and self.bundle_adjustment is None
+
     def detect(self, img):
         points = self.detector.detect(img)
         return np.array([x.pt for x in points], dtype=np.float32).reshape(-1, 1, 2)
 
     def get_best_point_corespondence(self):
-        T4 = decompose_E(self.E)
-        best_num_visible = 0
-        for T in T4:
-            P1 = np.array([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0]])
-            P2 = T[:3, :]
-            X1 = triangulate_many(self.xy1, self.xy2, P1, P2)
-            X2 = T@X1
-            num_visible = np.sum((X1[2, :] > 0) & (X2[2, :] > 0))
-            if num_visible > best_num_visible:
-                best_num_visible = num_visible
-                best_T = T
-                best_X1 = X1
-        T = best_T
-        self.T = best_T
-        X = best_X1
+        T = select_pose_by_cheirality(decompose_E(self.E), self.xy1, self.xy2)
+        P1 = np.array([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0]])
+        X = triangulate_many(self.xy1, self.xy2, P1, T[:3, :])
+        self.T = T
         return X, T
 
     def reset_initial_conditions(self):
@@ -295,79 +574,183 @@ class VisualOdometry:
         r[uv.shape[1]:] = (uv_hat[1] - uv[1])
         return r**2
 
+    def residualJacobian(self, uv, p, XY01):
+        """The residuals of residualFunction and their analytic Jacobian"""
+        uv_hat, Ju, Jv = reprojection_jacobian(self.camera.K, self.T, p, XY01)
+        e = np.concatenate([uv_hat[0] - uv[0], uv_hat[1] - uv[1]])
+        J = np.concatenate([Ju, Jv])
+        # The residuals are squared, d(e**2)/dp = 2 e de/dp
+        return e**2, 2*e[:, None]*J
+
+    def refine_pose(self, uv, X):
+        """Refines the pose perturbation p around self.T minimizing the residuals of residualFunction"""
+        p0 = np.array([0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
+        if self.refinement == "finite_difference":
+            return levenberg_marquardt(lambda p: self.residualFunction(uv, p, X), p0)
+        if self.refinement == "least_squares":
+            result = least_squares(lambda p: self.residualJacobian(uv, p, X)[0], p0,
+                                   jac=lambda p: self.residualJacobian(uv, p, X)[1], method="lm")
+            return result.x
+        return levenberg_marquardt_analytic(lambda p: self.residualJacobian(uv, p, X), p0)
+
     # Create a rotation matrix based on pose p
 
     def rotationMatrix(self, p):
         rotation = rotate_x(p[0]) @ rotate_y(p[1]) @ rotate_z(p[2]) @ translate(p[3], p[4], p[5]) @ self.T
         return rotation
 
-    def track(self, image):
-        image = self.camera.undistort_image(np.array(image))
-
+    def track(self, image, imu_motion=None):
+        """
+        Tracks a new frame and returns the rotation and translation of the body since
+        the last reset, or None if the frame is skipped by the keyframe policy.
+        imu_motion is the optional IMU rotation matrix and translation of the body
+        since the previous frame.
+        """
+        return self.integrate_motion(self.estimate_motion(image, imu_motion))
+
+    def estimate_motion(self, image, imu_motion=None):
+        """
+        Estimates the motion of the camera from the last keyframe to the new frame as (R, t, frames),
+        the rotation and unit translation in the last keyframe's camera frame and the number of frames
+        since that keyframe. The first frame gives frames = 0 and skipped frames give None.
+        The motions do not depend on resets or the scale, so they can be cached, see VisualOdometryCache
+        """
         # Track stuff
         if self.old_image is not None:
-
-            self.kp1, self.des1 = self.detector.detectAndCompute(self.old_image, None)
-            self.kp2, self.des2 = self.detector.detectAndCompute(image, None)
-            matches = self.matcher.knnMatch(self.des1, self.des2, k=2)
-
-            imageIndexes = []
-            good = []
-            for m, n in matches:
-                if m.distance < 0.8*n.distance:
-                    imageIndexes.append([m.queryIdx, m.trainIdx])
-                    good.append([m])
-
-            #img3 = cv2.drawMatchesKnn(self.old_image, self.kp1, image, self.kp2, good, None, flags=cv2.DrawMatchesFlags_NOT_DRAW_SINGLE_POINTS)
-            # plt.imshow(img3)
-            # plt.show()
-            self.remove_outliers_with_ransac(imageIndexes)
-            self.E = estimate_E(self.xy1, self.xy2)
-            # Start extrating T
-            self.X, T = self.get_best_point_corespondence()
-            p0 = np.array([0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
-
-            def residualsfun(p):
-                return self.residualFunction(self.uv2, p, self.X)
-
-            p = levenberg_marquardt(residualsfun, p0)
+            self.frames_since_keyframe += 1
+            if imu_motion is not None:
+                self.accumulate_keyframe_motion(*imu_motion)
+                if self.below_keyframe_motion():
+                    return None
+
+            image = self.prepare_image(image)
+            if self.frontend == "klt":
+                uv1, uv2 = self.track_features(image)
+                if len(uv1) == 0:
+                    # The previous frame had no features, tracking continues from this frame
+                    return None
+            else:
+                uv1, uv2 = self.match_features(image)
+            if self.keyframe_parallax > 0 and median_parallax(uv1, uv2) < self.keyframe_parallax:
+                return None
+
+            rotation_prior = self.imu_camera_rotation() if self.imu_aided and imu_motion is not None else None
+            inliers = self.estimate_geometry(uv1, uv2, rotation_prior)
+            # The refinement starts from self.T, with the IMU rotation if given
+            p = self.refine_pose(self.uv2, self.X)
             T = rotate_x(p[0]) @ rotate_y(p[1]) @ rotate_z(p[2])  @ translate(p[3], p[4], p[5]) @ self.T
 
             t = -T[:3, 3].reshape((3, 1))
             R = T[:3, :3].T
             #rotation = self.createYawRotation(R)
-
-            # Kinematic equations for VO in camera frame
-            self.t = self.scale * self.R @ t + self.t
-            self.R = self.R @ R
-            rotation = self.body_t_cam @ self.R @ self.body_t_cam.T
-            rotation = self.createYawRotation(rotation)
-
-            self.states.append(SE3(rotation, self.body_t_cam @ self.t))
+            frames = self.frames_since_keyframe
+            if self.bundle_adjustment is not None:
+                R, t = self.adjust_window(inliers, R, t, frames)
 
             # Reset the variables to the new varaibles
             self.old_image = image
+            self.reset_keyframe_motion()
+            if self.frontend == "klt":
+                self.update_tracked_features(image, inliers)
+            else:
+                self.old_keypoints, self.old_descriptors = self.kp2, self.des2
 
             # Show the images at each iteration
-            keypoints = self.detector.detect(image, None)
-            keypoints, descriptors = self.detector.compute(image, keypoints)
-            new_img = cv2.drawKeypoints(
-                image, keypoints, None, color=(0, 255, 0), flags=0)
-            cv2.imshow("Frame", new_img)
-            cv2.waitKey(1)
-            return rotation, self.body_t_cam @ self.t
+            if self.visualization is not None:
+                keypoints = cv2.KeyPoint_convert(self.old_points) if self.frontend == "klt" else self.kp2
+                self.visualization.submit(image, keypoints)
+            return R, t, frames
 
         else:
             # Case for first image
+            image = self.prepare_image(image)
             self.old_image = image
-
+            self.reset_keyframe_motion()
+            if self.frontend == "klt":
+                self.old_gray = grayscale(image)
+                self.old_points = self.detect(image)
+            else:
+                self.old_keypoints, self.old_descriptors = self.detector.detectAndCompute(image, None)
+
+            if self.bundle_adjustment is not None:
+                self.bundle_adjustment.add_keyframe(np.eye(3), np.zeros(3))
+            return np.eye(3), np.zeros((3, 1)), 0
+
+    def integrate_motion(self, motion):
+        """Integrates a motion of estimate_motion and returns the pose of the body as track, None for skipped frames"""
+        if motion is None:
+            return None
+        R, t, frames = motion
+        if frames == 0:
+            # First frame
             self.R = np.eye(3)
             self.t = np.zeros((3, 1))
-            rotation = self.body_t_cam @ self.R @ self.body_t_cam.T
-            rotation = self.createYawRotation(rotation)
-
-            self.states.append(SE3(rotation, self.body_t_cam @ self.t))
-            return rotation, self.body_t_cam @ self.t
+        else:
+            # Kinematic equations for VO in camera frame, the scale is the distance moved per frame
+            self.t = self.scale * frames * self.R @ t + self.t
+            self.R = self.R @ R
+        rotation = self.body_t_cam @ self.R @ self.body_t_cam.T
+        rotation = self.createYawRotation(rotation)
+
+        self.states.append(SE3(rotation, self.body_t_cam @ self.t))
+        return rotation, self.body_t_cam @ self.t
+
+    def adjust_window(self, inliers, R, t, frames):
+        """
+        Adds the new keyframe and its inliers to the local bundle adjustment and returns the refined
+        motion R, t since the previous keyframe. The triangulated points are in the previous camera
+        frame with a unit baseline, which is the distance moved over the frames since that keyframe
+        """
+        step = self.scale * frames
+        self.bundle_adjustment.anchor(self.R, self.t)
+        # Only the points triangulated in front of both cameras become landmarks
+        visible = (self.X[2] > 0) & ((self.T @ self.X)[2] > 0)
+        features1, features2 = self.inlier_features(inliers)
+        X = (self.R @ (step * self.X[:3, visible]) + self.t).T
+        self.bundle_adjustment.add_keyframe(self.R @ R, step * self.R @ t + self.t)
+        self.bundle_adjustment.add_matches(features1[visible], features2[visible], self.uv1.T[visible], self.uv2.T[visible], X)
+        R_keyframe, t_keyframe = self.bundle_adjustment.optimize()
+        R_adjusted = self.R.T @ R_keyframe
+        t_adjusted = self.R.T @ (t_keyframe.reshape((3, 1)) - self.t) / step
+
+        rotation_change = np.linalg.norm(Rot.from_matrix(R.T @ R_adjusted).as_rotvec())
+        if rotation_change > self.ba_max_rotation_change or np.linalg.norm(t_adjusted - t) > self.ba_max_translation_change:
+            # The window diverged, it restarts from the two-view motion
+            self.bundle_adjustment.restart(self.R @ R, step * self.R @ t + self.t)
+            return R, t
+        return R_adjusted, t_adjusted
+
+    def inlier_features(self, inliers):
+        """Feature indices of the inliers in the previous keyframe and in the new frame"""
+        if self.frontend == "klt":
+            # The inliers are tracked on in the same order, see update_tracked_features
+            return self.tracked_indices[inliers], np.arange(np.sum(inliers))
+        return self.match_indices[inliers, 0], self.match_indices[inliers, 1]
+
+    def prepare_image(self, image):
+        image = self.camera.resize_image(np.array(image))
+        if not self.sparse_undistortion:
+            image = self.camera.undistort_image(image)
+        return image
+
+    def imu_camera_rotation(self):
+        """IMU rotation since the last keyframe as the rotation of the points from the previous camera frame to the new one"""
+        R_camera = self.body_t_cam.T @ self.keyframe_motion_R @ self.body_t_cam
+        return R_camera.T
+
+    def accumulate_keyframe_motion(self, R, t):
+        self.keyframe_motion_t = self.keyframe_motion_t + self.keyframe_motion_R @ np.ravel(t)
+        self.keyframe_motion_R = self.keyframe_motion_R @ R
+
+    def below_keyframe_motion(self):
+        """True if the IMU motion since the last keyframe is below both keyframe thresholds"""
+        angle = np.linalg.norm(Rot.from_matrix(self.keyframe_motion_R).as_rotvec())
+        return angle < self.keyframe_rotation and np.linalg.norm(self.keyframe_motion_t) < self.keyframe_translation
+
+    def reset_keyframe_motion(self):
+        self.frames_since_keyframe = 0
+        self.keyframe_motion_R = np.eye(3)
+        self.keyframe_motion_t = np.zeros(3)
 
     def update_scale(self, scale):
         self.scale = scale
@@ -376,17 +759,129 @@ class VisualOdometry:
         temp_rot = Rot.from_matrix(rotation).as_euler("xyz")
         return Rot.from_euler("xyz", [0, 0, temp_rot[2]]).as_matrix()
 
-    def remove_outliers_with_ransac(self, imageIndexes):
-        # Extract the uv points and their projection from the images
-        uv1, uv2 = getCommonImagePoints(imageIndexes, self.kp1, self.kp2)
-        xy1 = self.camera.Kinv @ uv1.T
-        xy2 = self.camera.Kinv @ uv2.T
-
-        # Calculate amount of the ransac trials and run ransac on the matches
-        num_trials = get_num_ransac_trials(8, 0.999, 0.50)
-        _, inliers = estimate_E_ransac(xy1, xy2, self.camera.K, 1.0, num_trials)
+    def match_features(self, image):
+        """ORB frontend, matches the features of the new image against the previous frame. Returns the homogeneous uv1, uv2 [n x 3]"""
+        # The features of the previous frame are kept from the previous call
+        self.kp1, self.des1 = self.old_keypoints, self.old_descriptors
+        self.kp2, self.des2 = self.detector.detectAndCompute(image, None)
+        matches = self.matcher.knnMatch(self.des1, self.des2, k=2)
+
+        imageIndexes = []
+        good = []
+        for m, n in matches:
+            if m.distance < 0.8*n.distance:
+                imageIndexes.append([m.queryIdx, m.trainIdx])
+                good.append([m])
+
+        self.match_indices = np.array(imageIndexes, dtype=int).reshape(-1, 2)
+        #img3 = cv2.drawMatchesKnn(self.old_image, self.kp1, image, self.kp2, good, None, flags=cv2.DrawMatchesFlags_NOT_DRAW_SINGLE_POINTS)
+        # plt.imshow(img3)
+        # plt.show()
+        return getCommonImagePoints(imageIndexes, self.kp1, self.kp2)
+
+    def track_features(self, image):
+        """
+        KLT frontend, tracks the points of the previous frame into the new image. Returns the homogeneous uv1, uv2 [n x 3].
+        If the previous frame has no features they are empty and the new frame replaces the previous one
+        """
+        self.gray = grayscale(image)
+        if len(self.old_points) == 0:
+            self.old_gray = self.gray
+            self.old_points = self.detect(image)
+            return np.empty((0, 3)), np.empty((0, 3))
+
+        points, status, _ = cv2.calcOpticalFlowPyrLK(self.old_gray, self.gray, self.old_points, None,
+                                                     winSize=self.klt_window, maxLevel=self.klt_levels)
+        tracked = status.ravel() == 1
+        self.tracked_indices = np.nonzero(tracked)[0]
+        self.points1 = self.old_points[tracked]
+        self.points2 = points[tracked]
+
+        uv1 = np.ones((len(self.points1), 3))
+        uv2 = np.ones((len(self.points2), 3))
+        uv1[:, :2] = self.points1.reshape(-1, 2)
+        uv2[:, :2] = self.points2.reshape(-1, 2)
+        return uv1, uv2
+
+    def update_tracked_features(self, image, inliers):
+        """Keeps tracking the RANSAC inliers, features are re-detected when too few are left"""
+        self.old_gray = self.gray
+        self.old_points = self.points2[inliers]
+        if len(self.old_points) < self.klt_min_features:
+            self.old_points = self.detect(image)
+            if self.bundle_adjustment is not None:
+                # The new points start new landmarks
+                self.bundle_adjustment.keyframes[-1].landmark_of_feature = {}
+
+    def estimate_geometry(self, uv1, uv2, rotation_prior=None):
+        """
+        Estimates E, the relative pose self.T and the triangulated inliers self.X from
+        the homogeneous uv1, uv2 [n x 3] with the selected geometry backend, or with the
+        two-point backend if the relative rotation of the points rotation_prior is known.
+        Returns the inlier mask
+        """
+        if rotation_prior is not None:
+            return self.estimate_pose_known_rotation(uv1, uv2, rotation_prior)
+        if self.geometry == "five_point":
+            return self.estimate_pose_five_point(uv1, uv2)
+
+        inliers = self.remove_outliers_with_ransac(uv1, uv2)
+        self.E = estimate_E_normalized(self.xy1, self.xy2)
+        # Start extrating T
+        self.X, _ = self.get_best_point_corespondence()
+        return inliers
+
+    def estimate_pose_five_point(self, uv1, uv2):
+        """Five-point RANSAC (or LMEDS) and cheirality check in OpenCV, sets the same state as the eight-point backend"""
+        uv1, uv2, xy1, xy2 = self.calibrate_points(uv1, uv2)
+        E, mask = cv2.findEssentialMat(uv1[:, :2], uv2[:, :2], self.camera.K, method=self.five_point_method,
+                                       prob=self.ransac_confidence, threshold=self.ransac_threshold)
+        inliers = mask.ravel() == 1
+        self.keep_inliers(inliers, uv1, uv2, xy1, xy2)
+
+        # OpenCV may return several solutions stacked, the first one has the most inliers
+        self.E = E[:3]
+        _, R, t, _ = cv2.recoverPose(self.E, self.uv1[:2].T, self.uv2[:2].T, self.camera.K)
+        self.T = SE3(R, t)
+        P1 = np.array([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0]])
+        self.X = triangulate_many(self.xy1, self.xy2, P1, self.T[:3, :])
+        return inliers
+
+    def estimate_pose_known_rotation(self, uv1, uv2, R):
+        """Two-point RANSAC on the translation with the rotation R held fixed, sets the same state as the eight-point backend"""
+        uv1, uv2, xy1, xy2 = self.calibrate_points(uv1, uv2)
+        num_trials = get_num_ransac_trials(2, self.ransac_confidence, 0.50)
+        _, inliers = estimate_t_ransac(xy1, xy2, R, self.camera.K, self.ransac_threshold, num_trials, confidence=self.ransac_confidence)
+        self.keep_inliers(inliers, uv1, uv2, xy1, xy2)
+
+        # Refit the translation on all inliers, its sign is given by the cheirality
+        t = estimate_t(translation_constraints(self.xy1, self.xy2, R))
+        self.E = skew(t)@R
+        self.T = select_pose_by_cheirality([SE3(R, t), SE3(R, -t)], self.xy1, self.xy2)
+        P1 = np.array([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0]])
+        self.X = triangulate_many(self.xy1, self.xy2, P1, self.T[:3, :])
+        return inliers
+
+    def calibrate_points(self, uv1, uv2):
+        """Undistorts uv1, uv2 [n x 3] if the frames are not undistorted, returns them with their normalized coordinates xy1, xy2 [3 x n]"""
+        if self.sparse_undistortion:
+            uv1[:, :2] = self.camera.undistort_points(uv1[:, None, :2])
+            uv2[:, :2] = self.camera.undistort_points(uv2[:, None, :2])
+        return uv1, uv2, self.camera.Kinv @ uv1.T, self.camera.Kinv @ uv2.T
+
+    def keep_inliers(self, inliers, uv1, uv2, xy1, xy2):
         # Remove outliers from the image coordinates
         self.xy1 = xy1[:, inliers]
         self.xy2 = xy2[:, inliers]
         self.uv1 = uv1.T[:, inliers]
         self.uv2 = uv2.T[:, inliers]
+
+    def remove_outliers_with_ransac(self, uv1, uv2):
+        """Runs RANSAC on the homogeneous uv1, uv2 [n x 3] and keeps the inliers. Returns the inlier mask"""
+        uv1, uv2, xy1, xy2 = self.calibrate_points(uv1, uv2)
+
+        # Calculate the maximum amount of the ransac trials and run ransac on the matches
+        num_trials = get_num_ransac_trials(8, self.ransac_confidence, 0.50)
+        _, inliers = estimate_E_ransac(xy1, xy2, self.camera.K, self.ransac_threshold, num_trials, confidence=self.ransac_confidence)
+        self.keep_inliers(inliers, uv1, uv2, xy1, xy2)
+        return inliers
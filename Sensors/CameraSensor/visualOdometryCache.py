@@ -0,0 +1,110 @@
+import hashlib
+import json
+from pathlib import Path
+import numpy as np
+
+"""
+Disk cache of the visual odometry of a dataset window.
+
+The motion VisualOdometry.estimate_motion gives for every camera frame is stored with the
+time stamp of the frame, keyed by the dataset window, the VO settings, including the camera
+intrinsics, and CACHE_VERSION. A later run with the same key replays the motions through
+VisualOdometry.integrate_motion instead of decoding and tracking the frames, the frames of a
+longer run are tracked and added. A motion depends on the frames tracked before it, so the
+motions are only replayed while the frames come in the cached order. From the first frame
+that does not match, e.g. when the fusion tracks the frames of a preinitialization window
+it skipped before, the frames are tracked again and the cache is rewritten. The resets and the scale of the fusion are applied when integrating, so changing the
+fusion tuning does not invalidate the cache. Only a VO that is VisualOdometry.cacheable is
+cached, with the IMU aiding or the bundle adjustment the motions depend on the fusion.
+"""
+
+# Version of the estimated motions and of the file, increased when VisualOdometry.estimate_motion
+# gives different motions for the same settings or the stored arrays change
+CACHE_VERSION = 2
+
+CACHE_DIRECTORY = Path.joinpath(Path(__file__).parents[2].absolute(), "DataSets", "Cache", "visual_odometry")
+
+
+class VisualOdometryCache:
+
+    def __init__(self, dataset_settings, visual_odometry) -> None:
+        self.key = {
+            "version": CACHE_VERSION,
+            "dataset": dataset_settings.dataset_number,
+            "bag_start_time_offset": dataset_settings.bag_start_time_offset,
+            "bag_duration": dataset_settings.bag_duration,
+            "visual_odometry": visual_odometry.settings(),
+        }
+        digest = hashlib.sha1(json.dumps(self.key, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        self.filepath = Path.joinpath(
+            CACHE_DIRECTORY,
+            f"trondheim{dataset_settings.dataset_number}_{dataset_settings.bag_start_time_offset}_{dataset_settings.bag_duration}_{digest}.npz"
+        )
+
+        # Motions and time stamps (ns) of the frames tracked so far, the cached frames are replayed first
+        self.motions, self.times = self.load() if self.filepath.exists() else ([], [])
+        self.num_cached = len(self.motions)
+        self.index = 0
+        self.modified = False
+
+    @property
+    def replaying(self):
+        return self.index < self.num_cached
+
+    def track(self, visual_odometry, measurement, imu_motion=None):
+        """Same as visual_odometry.track for a camera measurement, the cached frames are not decoded"""
+        time = measurement.time.to_nsec()
+        if self.index < self.num_cached and self.times[self.index] != time:
+            print("The camera frames differ from the cached ones from frame", self.index, "on, they are tracked again")
+            self.truncate(self.index)
+
+        if self.index < len(self.motions):
+            motion = self.motions[self.index]
+        else:
+            # Frames after the cached ones, e.g. of a longer run, are tracked and added to the cache
+            motion = visual_odometry.estimate_motion(measurement.image, imu_motion)
+            self.motions.append(motion)
+            self.times.append(time)
+            self.modified = True
+        self.index += 1
+        if motion is not None and motion[2] == 0 and self.index > 1:
+            # The tracking restarted after the cached frames, the first tracked frame has no motion
+            return None
+        return visual_odometry.integrate_motion(motion)
+
+    def truncate(self, length):
+        """Drops the cached motions from the frame length on"""
+        del self.motions[length:]
+        del self.times[length:]
+        self.num_cached = min(self.num_cached, length)
+        self.modified = True
+
+    def load(self):
+        data = np.load(self.filepath)
+        motions = [None if frames < 0 else (R, t.reshape((3, 1)), int(frames)) for R, t, frames in zip(data["R"], data["t"], data["frames"])]
+        return motions, data["time"].tolist()
+
+    def save(self, motions=None, times=None):
+        """
+        Writes the motions if the cache changed, motions and times (ns) are those of the frames
+        of a VisualOdometryService if given, which tracks all frames of the run
+        """
+        if motions is not None:
+            self.truncate(0)
+            self.motions, self.times = list(motions), list(times)
+        motions = self.motions
+        if not self.modified:
+            return
+        # Skipped frames are stored with frames = -1
+        R = np.array([np.eye(3) if motion is None else motion[0] for motion in motions]).reshape((-1, 3, 3))
+        t = np.array([np.zeros(3) if motion is None else np.ravel(motion[1]) for motion in motions]).reshape((-1, 3))
+        frames = np.array([-1 if motion is None else motion[2] for motion in motions], dtype=int)
+
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(self.filepath, R=R, t=t, frames=frames, time=np.array(self.times, dtype=np.int64))
+        with open(self.filepath.with_suffix(".json"), "w") as key_file:
+            json.dump(self.key, key_file, indent=2, default=str)
+        print("Saved", len(motions), "visual odometry frames to", self.filepath)
+
+    def __repr__(self) -> str:
+        return f"VisualOdometryCache[{self.filepath.name}, cached={self.num_cached}, frames={len(self.motions)}]"
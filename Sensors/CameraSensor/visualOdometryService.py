@@ -0,0 +1,143 @@
+import multiprocessing
+import queue
+import traceback
+from collections import deque
+from Sensors.CameraSensor.visualOdometry import VisualOdometry
+from Sensors.CameraSensor.visualizationSink import VisualizationSink
+
+
+def run_visual_odometry(requests, results, vo_settings, frames):
+    """Worker process, tracks the submitted frames in order and returns one result for each frame. frames is the queue of a VisualizationSink"""
+    try:
+        visual_odometry = VisualOdometry(visualization=VisualizationSink.attach(frames) if frames is not None else None, **vo_settings)
+        while True:
+            request = requests.get()
+            command = request[0]
+            if command == "frame":
+                first_frame = visual_odometry.old_image is None
+                motion = visual_odometry.estimate_motion(request[1], request[2])
+                result = visual_odometry.integrate_motion(motion)
+                # The first frame only starts the tracking and skipped frames have no motion to report
+                results.put(("frame", None if first_frame else result, motion))
+            elif command == "reset":
+                visual_odometry.reset_initial_conditions()
+            elif command == "scale":
+                visual_odometry.update_scale(request[1])
+            elif command == "close":
+                return
+    except Exception:
+        # Raised again in the fusion process by VisualOdometryService
+        results.put(("error", traceback.format_exc()))
+
+
+class VisualOdometryService:
+    """Runs the visual odometry in a separate process, so the fusion loop does not wait for it.
+
+    Frames are submitted with the key of the state they belong to and the anchor pose their
+    result is relative to, and the results come back tagged with both. Resets and scale
+    updates are forwarded in order with the frames, so every result is relative to the pose
+    of the last reset before its frame, as with the inline VisualOdometry. At most queue_size
+    requests wait for the worker, after that submit blocks until the worker catches up.
+    The estimated motions of the frames are kept in motions, with the time stamps of the frames
+    given to submit in motion_times, for the VisualOdometryCache.
+    If the worker fails or exits, the next call waiting for it raises a RuntimeError with
+    the traceback of the worker instead of blocking.
+    """
+
+    # Seconds between the checks of the worker while waiting for it
+    poll_interval = 0.5
+
+    def __init__(self, noise_values=0, show_frames=False, queue_size=16, **vo_settings) -> None:
+        self.noise_values = noise_values
+        self.submitted = 0
+        self.received = 0
+        # Keys and anchors of the frames waiting for their results, in submission order
+        self.pending = deque()
+        self.motions = []
+        self.motion_times = []
+
+        context = multiprocessing.get_context("spawn")
+        self.requests = context.Queue(maxsize=queue_size)
+        self.results_queue = context.Queue()
+        vo_settings["noise_values"] = noise_values
+        # The window is shown by a sink process of this process, the daemonic worker can not start processes
+        self.visualization = VisualizationSink() if show_frames else None
+        frames = self.visualization.frames if self.visualization is not None else None
+        self.process = context.Process(target=run_visual_odometry, args=(self.requests, self.results_queue, vo_settings, frames), daemon=True)
+        self.process.start()
+
+    def submit(self, key, image, anchor=None, imu_motion=None, time=None):
+        self.put(("frame", image, imu_motion))
+        self.pending.append((key, anchor, time))
+        self.submitted += 1
+
+    def reset_initial_conditions(self):
+        self.put(("reset",))
+
+    def update_scale(self, scale):
+        self.put(("scale", scale))
+
+    def results(self, wait=False):
+        """Returns the (key, anchor, rotation, translation) results that have arrived, waits for all pending frames if wait"""
+        results = []
+        while self.pending:
+            message = self.get(wait)
+            if message is None:
+                break
+            _, result, motion = message
+            key, anchor, time = self.pending.popleft()
+            self.motions.append(motion)
+            self.motion_times.append(time)
+            self.received += 1
+            if result is not None:
+                rotation, translation = result
+                results.append((key, anchor, rotation, translation))
+        return results
+
+    def close(self):
+        """Waits for the submitted frames, stops the worker and returns the remaining results"""
+        results = self.results(wait=True)
+        self.put(("close",))
+        self.process.join()
+        if self.visualization is not None:
+            self.visualization.close()
+        return results
+
+    def put(self, request):
+        """Sends a request to the worker, waits while the request queue is full"""
+        while True:
+            try:
+                self.requests.put(request, timeout=self.poll_interval)
+                return
+            except queue.Full:
+                self.check_worker()
+
+    def get(self, wait):
+        """Next frame message of the worker, None if there is none and not wait"""
+        while True:
+            try:
+                message = self.results_queue.get(timeout=self.poll_interval) if wait else self.results_queue.get_nowait()
+            except queue.Empty:
+                self.check_worker()
+                if not wait:
+                    return None
+                continue
+            if message[0] == "error":
+                raise RuntimeError("Visual odometry worker failed:\n" + message[1])
+            return message
+
+    def check_worker(self):
+        """Raises if the worker has stopped, with its traceback if it sent one"""
+        if self.process.is_alive():
+            return
+        while True:
+            try:
+                message = self.results_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                break
+            if message[0] == "error":
+                raise RuntimeError("Visual odometry worker failed:\n" + message[1])
+        raise RuntimeError(f"Visual odometry worker exited with code {self.process.exitcode}")
+
+    def __repr__(self) -> str:
+        return f"VisualOdometryService[submitted={self.submitted}, received={self.received}]"
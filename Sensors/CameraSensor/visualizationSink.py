@@ -0,0 +1,83 @@
+import multiprocessing
+import queue
+import cv2
+
+
+def show_frames(frames, window_name):
+    """Sink process, shows the frames and their keypoints until None is received"""
+    shown = 0
+    while True:
+        item = frames.get()
+        if item is None:
+            break
+        image, points = item
+        cv2.imshow(window_name, cv2.drawKeypoints(image, cv2.KeyPoint_convert(points), None, color=(0, 255, 0), flags=0))
+        cv2.waitKey(1)
+        shown += 1
+    if shown:
+        cv2.destroyWindow(window_name)
+
+
+class VisualizationSink:
+    """Shows the tracked frames and their keypoints in a window of a separate process.
+
+    HighGUI is not thread safe, so the window is owned by the main thread of a spawned
+    process. Frames are handed over through a bounded queue. While the queue is full the
+    newest frame waits in this process and replaces the frame waiting before it, which is
+    dropped, so the VO never waits for the window and the fusion throughput does not depend
+    on whether anyone is watching. Frames are dropped before they are sent, as taking a frame
+    back out of the queue would read it through the pipe. A sink attached to the queue of a
+    sink in another process, see attach, submits to that sink's window.
+    """
+
+    def __init__(self, queue_size=2, window_name="Frame", frames=None) -> None:
+        self.submitted = 0
+        self.dropped = 0
+        # Newest frame not sent yet, while the queue is full
+        self.pending = None
+        self.process = None
+        if frames is None:
+            context = multiprocessing.get_context("spawn")
+            frames = context.Queue(maxsize=queue_size)
+            self.process = context.Process(target=show_frames, args=(frames, window_name), daemon=True)
+            self.process.start()
+        self.frames = frames
+        # Frames not sent when the process exits are discarded, even if the sink process is gone
+        self.frames.cancel_join_thread()
+
+    @classmethod
+    def attach(cls, frames):
+        """Sink submitting to the frames queue of a sink in another process, e.g. of a VisualOdometryService"""
+        return cls(frames=frames)
+
+    def submit(self, image, keypoints):
+        """Hands a frame and its keypoints to the sink process, dropping the older waiting frame if it lags behind"""
+        if self.pending is not None:
+            self.dropped += 1
+        self.pending = (image, cv2.KeyPoint_convert(keypoints))
+        self.submitted += 1
+        try:
+            self.frames.put_nowait(self.pending)
+            self.pending = None
+        except queue.Full:
+            pass
+
+    def close(self):
+        """Shows the frames still in the queue and closes the window, attached sinks leave it to the owner"""
+        if self.process is None:
+            return
+        # The waiting frame, then the end of the frames
+        items = [None] if self.pending is None else [self.pending, None]
+        for item in items:
+            while self.process.is_alive():
+                try:
+                    self.frames.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+        self.pending = None
+        self.process.join()
+        self.process = None
+
+    def __repr__(self) -> str:
+        return f"VisualizationSink[submitted={self.submitted}, dropped={self.dropped}]"
@@ -0,0 +1,68 @@
+import numpy as np
+import scipy.io
+
+
+class NEDFrame:
+    """Local north-east-down frame at a geodetic origin on the WGS84 ellipsoid.
+
+    The ECEF position of the origin and the ECEF to NED rotation are computed once,
+    and whole arrays of fixes are converted in one vectorized call. The result
+    matches pymap3d.geodetic2ned with ell=Ellipsoid("wgs84") and deg=True.
+    """
+
+    SEMI_MAJOR_AXIS = 6378137.0
+    FLATTENING = 1 / 298.257223563
+    ECCENTRICITY_SQUARED = FLATTENING * (2 - FLATTENING)
+
+    # Frames loaded from an origin file, shared by everything using the same file
+    _frames = {}
+
+    def __init__(self, latitude, longitude, altitude) -> None:
+        self.origin = np.array([latitude, longitude, altitude], dtype=float)
+        self.origin_ecef = NEDFrame.geodetic_to_ecef(latitude, longitude, altitude)
+
+        phi = np.radians(latitude)
+        lam = np.radians(longitude)
+        self.R_ned_ecef = np.array(
+            [
+                [-np.sin(phi) * np.cos(lam), -np.sin(phi) * np.sin(lam), np.cos(phi)],
+                [-np.sin(lam), np.cos(lam), 0.0],
+                [-np.cos(phi) * np.cos(lam), -np.cos(phi) * np.sin(lam), -np.sin(phi)],
+            ]
+        )
+
+    @classmethod
+    def from_mat(cls, filepath):
+        """Frame with the origin stored in a ned_origin.mat file, loaded once per file"""
+        key = str(filepath)
+        if key not in cls._frames:
+            data = scipy.io.loadmat(filepath)
+            cls._frames[key] = cls(data["lat0"][0][0], data["lon0"][0][0], data["height0"][0][0])
+        return cls._frames[key]
+
+    @staticmethod
+    def geodetic_to_ecef(latitude, longitude, altitude):
+        """Converts geodetic coordinates in degrees and meters to ECEF, returns [..., 3]"""
+        phi = np.radians(np.asarray(latitude, dtype=float))
+        lam = np.radians(np.asarray(longitude, dtype=float))
+        altitude = np.asarray(altitude, dtype=float)
+
+        sin_phi = np.sin(phi)
+        cos_phi = np.cos(phi)
+        N = NEDFrame.SEMI_MAJOR_AXIS / np.sqrt(1 - NEDFrame.ECCENTRICITY_SQUARED * sin_phi ** 2)
+        return np.stack(
+            [
+                (N + altitude) * cos_phi * np.cos(lam),
+                (N + altitude) * cos_phi * np.sin(lam),
+                (N * (1 - NEDFrame.ECCENTRICITY_SQUARED) + altitude) * sin_phi,
+            ],
+            axis=-1,
+        )
+
+    def geodetic_to_ned(self, latitude, longitude, altitude):
+        """Converts geodetic coordinates in degrees and meters to NED, returns [..., 3]"""
+        ecef = NEDFrame.geodetic_to_ecef(latitude, longitude, altitude)
+        return (ecef - self.origin_ecef) @ self.R_ned_ecef.T
+
+    def __repr__(self) -> str:
+        return f"NEDFrame[lat0={self.origin[0]}, lon0={self.origin[1]}, height0={self.origin[2]}]"
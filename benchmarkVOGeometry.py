@@ -0,0 +1,80 @@
+import time
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+from Sensors.CameraSensor.visualOdometry import VisualOdometry, SE3
+
+"""
+Compares the relative pose backends of the VO on a synthetic scene with known motion.
+
+Points in front of the camera are projected into two frames with the camera intrinsics,
+pixel noise is added and a fraction of the correspondences is replaced by outliers.
+Each backend then estimates the inliers and the relative pose from the same correspondences.
+The IMU-aided two-point backend is given the true rotation with ROTATION_PRIOR_NOISE added.
+"""
+
+NUMBER_OF_FRAMES = 100
+NUMBER_OF_POINTS = 200
+PIXEL_NOISE = 0.5
+OUTLIER_FRACTIONS = [0.1, 0.3, 0.5]
+# Error of the IMU rotation given to the two-point backend [rad]
+ROTATION_PRIOR_NOISE = np.radians(0.05)
+
+
+def synthetic_correspondences(K, rng, outlier_fraction):
+    # Forward motion of about a meter with a small rotation, as between two frames on the vessel
+    T = SE3(R.from_euler("xyz", rng.normal(0, 0.02, 3)).as_matrix(), np.array([0.1, 0.0, 1.0]) + rng.normal(0, 0.05, 3))
+    X1 = np.vstack([rng.uniform(-10, 10, NUMBER_OF_POINTS), rng.uniform(-4, 4, NUMBER_OF_POINTS), rng.uniform(5, 50, NUMBER_OF_POINTS), np.ones(NUMBER_OF_POINTS)])
+    X2 = T @ X1
+
+    uv1 = (K @ (X1[:3] / X1[2])).T
+    uv2 = (K @ (X2[:3] / X2[2])).T
+    uv1[:, :2] += rng.normal(0, PIXEL_NOISE, (NUMBER_OF_POINTS, 2))
+    uv2[:, :2] += rng.normal(0, PIXEL_NOISE, (NUMBER_OF_POINTS, 2))
+
+    outliers = rng.random(NUMBER_OF_POINTS) < outlier_fraction
+    uv2[outliers, :2] = rng.uniform([0, 0], [1920, 1200], (np.sum(outliers), 2))
+    return uv1, uv2, T, ~outliers
+
+
+def angle_between(a, b):
+    return np.degrees(np.arccos(np.clip(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)), -1, 1)))
+
+
+def benchmark(geometry, outlier_fraction, seed=0, rotation_prior=False):
+    rng = np.random.default_rng(seed)
+    np.random.seed(seed)
+    visual_odometry = VisualOdometry(geometry=geometry)
+    K = visual_odometry.camera.K
+
+    times, rotation_errors, translation_errors, precisions, recalls = [], [], [], [], []
+    for _ in range(NUMBER_OF_FRAMES):
+        uv1, uv2, T, true_inliers = synthetic_correspondences(K, rng, outlier_fraction)
+
+        R_prior = T[:3, :3] @ R.from_rotvec(rng.normal(0, ROTATION_PRIOR_NOISE, 3)).as_matrix() if rotation_prior else None
+        start = time.perf_counter()
+        inliers = visual_odometry.estimate_geometry(uv1, uv2, R_prior)
+        times.append(time.perf_counter() - start)
+
+        T_hat = visual_odometry.T
+        rotation_errors.append(np.degrees(np.linalg.norm(R.from_matrix(T_hat[:3, :3].T @ T[:3, :3]).as_rotvec())))
+        translation_errors.append(angle_between(T_hat[:3, 3], T[:3, 3]))
+        precisions.append(np.sum(inliers & true_inliers) / max(np.sum(inliers), 1))
+        recalls.append(np.sum(inliers & true_inliers) / np.sum(true_inliers))
+
+    return {
+        "time [ms]": 1000 * np.median(times),
+        "rotation error [deg]": np.median(rotation_errors),
+        "translation error [deg]": np.median(translation_errors),
+        "inlier precision": np.mean(precisions),
+        "inlier recall": np.mean(recalls),
+    }
+
+
+if __name__ == "__main__":
+    for outlier_fraction in OUTLIER_FRACTIONS:
+        print(f"\n-- {int(100 * outlier_fraction)}% outliers, {NUMBER_OF_POINTS} correspondences, {NUMBER_OF_FRAMES} frames")
+        for geometry in VisualOdometry.GEOMETRIES:
+            results = benchmark(geometry, outlier_fraction)
+            print(f"{geometry:>12}: " + ", ".join(f"{key} {value:.3f}" for key, value in results.items()))
+        results = benchmark("eight_point", outlier_fraction, rotation_prior=True)
+        print(f"{'two_point':>12}: " + ", ".join(f"{key} {value:.3f}" for key, value in results.items()))
@@ -15,6 +15,10 @@ from Utils.gtsam_pose_utils import gtsam_pose_from_result, gtsam_landmark_from_r
 from Plotting.plot_gtsam import plot_horizontal_trajectory, plot_position, plot_angels, plot_bias, plot_vel, plot_threedof_error, plot_threedof2, new_xy_plot, ATE
 import seaborn as sns
 from Sensors.CameraSensor.visualOdometry import VisualOdometry
+from Sensors.CameraSensor.visualizationSink import VisualizationSink
+from Sensors.CameraSensor.visualOdometryService import VisualOdometryService
+from Sensors.CameraSensor.visualOdometryCache import VisualOdometryCache
+from Sensors.CameraSensor.camera import PinholeCamera
 
 from uwbCamImuTuning import *
 
@@ -22,7 +26,8 @@ from uwbCamImuTuning import *
 class GtSAMTest:
 
     def __init__(self) -> None:
-        self.dataset: ROSData = ROSData(DATASET_NUMBER)
+        self.dataset: ROSData = ROSData(DATASET_NUMBER, prefetch_size=PREFETCH_SIZE, prefetch_images=True, decode_workers=DECODE_WORKERS,
+                                         decode_options=dict(reduction=PinholeCamera(VO_PROCESSING_SCALE).decode_reduction()))
         isam_params: gtsam.ISAM2Params = gtsam.ISAM2Params()
         isam_params.setFactorization("QR")
         isam_params.setRelinearizeSkip(1)
@@ -85,6 +90,8 @@ class GtSAMTest:
         self.graph_values.insert(B1, self.current_bias)
         self.time_stamps.append(self.ground_truth.time[0])
         self.prev_image_state = None
+        # IMU motion since the previous camera frame, None before the first frame
+        self.imu_motion = None
 
     def add_UWB_to_graph(self, uwb_measurement):
 
@@ -150,8 +157,14 @@ class GtSAMTest:
             )
         )
 
+        previous_pose = self.navstate.pose()
         self.navstate = integrated_measurement.predict(
             self.navstate, self.current_bias)
+        if self.imu_motion is not None:
+            # The rotation is the preintegrated gyro rotation, the translation the predicted one of this interval,
+            # so the motion does not include the jumps of the state at the ISAM updates
+            translation = previous_pose.between(self.navstate.pose()).translation()
+            self.imu_motion = self.imu_motion.compose(gtsam.Pose3(integrated_measurement.deltaRij(), translation))
         velocityNED = self.navstate.pose().rotation().matrix() @ self.navstate.velocity()
         velocityNED[2] = 0
 
@@ -213,13 +226,34 @@ class GtSAMTest:
             print("Pose of vessel:", self.current_pose.translation())
             print("Pose of anchor:", uwb_position.position(), "\n")
 
-    def add_vo_to_graph(self, rotation, transelation):
-        transelation = self.current_pose.rotation().matrix() @ transelation + self.current_pose.translation().reshape((3, 1))
-        rotation = self.current_pose.rotation().matrix() @ rotation
+    def add_vo_to_graph(self, rotation, transelation, key=None, anchor_pose=None):
+        # Asynchronous VO results belong to the state and anchor pose of their frame
+        key = self.pose_variables[-1] if key is None else key
+        anchor_pose = self.current_pose if anchor_pose is None else anchor_pose
+
+        transelation = anchor_pose.rotation().matrix() @ transelation + anchor_pose.translation().reshape((3, 1))
+        rotation = anchor_pose.rotation().matrix() @ rotation
         transelation[2] = -0.7
 
         pose = gtsam.Pose3(gtsam.Rot3(rotation), transelation)
-        self.factor_graph.add(gtsam.PriorFactorPose3(self.pose_variables[-1], pose, gtsam.noiseModel.Diagonal.Sigmas(self.visual_odometry.noise_values)))
+        self.factor_graph.add(gtsam.PriorFactorPose3(key, pose, gtsam.noiseModel.Diagonal.Sigmas(self.visual_odometry.noise_values)))
+
+    def imu_motion_since_previous_frame(self):
+        """Rotation and translation of the body since the previous camera frame from the IMU preintegration, see add_imu_factor"""
+        motion = self.imu_motion
+        self.imu_motion = gtsam.Pose3()
+        if motion is None:
+            return None
+        return motion.rotation().matrix(), motion.translation()
+
+    def track_frame(self, measurement, imu_motion=None):
+        if self.vo_cache is None:
+            return self.visual_odometry.track(measurement.image, imu_motion)
+        return self.vo_cache.track(self.visual_odometry, measurement, imu_motion)
+
+    def add_vo_results_to_graph(self, results):
+        for key, anchor_pose, rotation, transelation in results:
+            self.add_vo_to_graph(rotation, transelation, key, anchor_pose)
 
     def run(self):
         # Dummy variable for storing imu measurements
@@ -264,7 +298,29 @@ class GtSAMTest:
                     self.current_bias = result.atConstantBias(self.imu_bias_variables[-1])
                     gnss_counter = 0
 
-        self.visual_odometry = VisualOdometry(noise_values=VO_SIGMAS)
+        vo_settings = dict(processing_scale=VO_PROCESSING_SCALE, keyframe_parallax=VO_KEYFRAME_PARALLAX,
+                           keyframe_rotation=VO_KEYFRAME_ROTATION, keyframe_translation=VO_KEYFRAME_TRANSLATION,
+                           bundle_adjustment_window=VO_BUNDLE_ADJUSTMENT_WINDOW, imu_aided=VO_IMU_AIDED)
+        visual_odometry = VisualOdometry(noise_values=VO_SIGMAS, **vo_settings)
+        # Replays the VO motions of an earlier run with the same dataset window and VO settings, unless they depend on the fusion
+        self.vo_cache = None
+        if VO_CACHE and not visual_odometry.cacheable():
+            print("The VO uses the IMU motions or the bundle adjustment, it is not cached")
+        elif VO_CACHE:
+            self.vo_cache = VisualOdometryCache(self.dataset.dataset_settings, visual_odometry)
+        replaying = self.vo_cache is not None and self.vo_cache.replaying
+        if replaying:
+            # The cached frames are not decoded, the frames after them are decoded when tracked
+            self.dataset.stop_image_decoder()
+            self.dataset.prefetch_images = False
+
+        # The cached motions are replayed inline, they take no time
+        self.async_vo = ASYNC_VO and not replaying
+        if self.async_vo:
+            self.visual_odometry = VisualOdometryService(noise_values=VO_SIGMAS, show_frames=SHOW_VO_FRAMES, **vo_settings)
+        else:
+            self.visual_odometry = visual_odometry
+            self.visual_odometry.visualization = VisualizationSink() if SHOW_VO_FRAMES else None
         imu_measurements = []
         self.visual_odometry.update_scale(0.25)
         length_of_preinitialization = len(self.pose_variables)
@@ -285,18 +341,27 @@ class GtSAMTest:
                     self.add_UWB_to_graph(measurement)
 
                 if measurement.measurement_type.value == "Camera":
-                    if self.prev_image_state is None:
-                        self.visual_odometry.track(measurement.image)
+                    imu_motion = self.imu_motion_since_previous_frame()
+                    if self.async_vo:
+                        self.visual_odometry.submit(self.pose_variables[-1], measurement.image, self.current_pose, imu_motion, measurement.time.to_nsec())
+                    elif self.prev_image_state is None:
+                        self.track_frame(measurement, imu_motion)
                         self.prev_image_state = self.pose_variables[-1]
                     else:
-                        rotation, trans = self.visual_odometry.track(measurement.image)
-                        self.add_vo_to_graph(rotation, trans)
-                        self.prev_image_state = self.pose_variables[-1]
+                        # Frames skipped by the keyframe policy give no result
+                        vo_result = self.track_frame(measurement, imu_motion)
+                        if vo_result is not None:
+                            rotation, trans = vo_result
+                            self.add_vo_to_graph(rotation, trans)
+                            self.prev_image_state = self.pose_variables[-1]
 
             elif measurement.measurement_type.value == "IMU":
                 # Store the IMU factors unntil a new UWB measurement is recieved
                 imu_measurements.append(measurement)
 
+            if self.async_vo:
+                self.add_vo_results_to_graph(self.visual_odometry.results())
+
             iteration_number += 1
             print("Iteration", iteration_number, len(self.pose_variables), len(self.time_stamps))
 
@@ -319,6 +384,17 @@ class GtSAMTest:
                 if len(self.pose_variables) > NUMBER_OF_RUNNING_ITERATIONS:
                     break
 
+        if self.async_vo:
+            self.add_vo_results_to_graph(self.visual_odometry.close())
+            print("Visual odometry:", self.visual_odometry)
+            if self.vo_cache is not None:
+                self.vo_cache.save(self.visual_odometry.motions, self.visual_odometry.motion_times)
+        else:
+            if self.vo_cache is not None:
+                self.vo_cache.save()
+            if self.visual_odometry.visualization is not None:
+                self.visual_odometry.visualization.close()
+        print("Measurement read-ahead:", self.dataset.prefetcher)
         self.isam.update(self.factor_graph, self.graph_values)
         result = self.isam.calculateBestEstimate()
         positions, eulers = gtsam_pose_from_result(result)
@@ -357,5 +433,7 @@ class GtSAMTest:
         """
 
 
-testing = GtSAMTest()
-testing.run()
+# The guard keeps the image decoding processes from running the fusion when they import this module
+if __name__ == "__main__":
+    testing = GtSAMTest()
+    testing.run()
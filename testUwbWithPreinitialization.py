@@ -1,10 +1,11 @@
 import gtsam
-from DataSets.extractData import ROSData
+from DataSets.extractData import ROSData, CachedROSData
 from DataSets.extractGt import GroundTruthEstimates
 from gtsam.symbol_shorthand import X, L, V, B
 import numpy as np
 from settings import DATASET_NUMBER
 from DataTypes.uwb_position import UWB_Ancors_Descriptor
+from DataTypes.measurement import IMUBlock
 
 from scipy.spatial.transform import Rotation as R
 from Sensors.IMU import IMU
@@ -21,7 +22,7 @@ from uwbPreinitializationTuning import *
 class GtSAMTest:
 
     def __init__(self) -> None:
-        self.dataset: ROSData = ROSData(DATASET_NUMBER)
+        self.dataset: ROSData = CachedROSData(DATASET_NUMBER, topics=["/sentiboard/adis", "/uwb_beacons_parsed", "/ublox2/fix"])
         isam_params: gtsam.ISAM2Params = gtsam.ISAM2Params()
         isam_params.setFactorization("QR")
         isam_params.setRelinearizeSkip(1)
@@ -115,15 +116,15 @@ class GtSAMTest:
         self.factor_graph = gtsam.NonlinearFactorGraph()
         self.uwb_counter = set()
 
-    def pre_integrate_imu_measurement(self, imu_measurements):
+    def pre_integrate_imu_measurement(self, imu_block):
         summarized_measurement = gtsam.PreintegratedImuMeasurements(
             self.imu_params.preintegration_param, self.current_bias)
 
         deltaT = 1 / self.dataset.dataset_settings.imu_frequency
 
-        for measurement in imu_measurements:
+        for linear_vel, angular_vel in zip(imu_block.linear_vel, imu_block.angular_vel):
             summarized_measurement.integrateMeasurement(
-                measurement.linear_vel, measurement.angular_vel, deltaT)
+                linear_vel, angular_vel, deltaT)
 
         return summarized_measurement
 
@@ -221,14 +222,15 @@ class GtSAMTest:
         if GNSS_PREINIT_ENABLED:
             gnss_counter = 0
             # 10 secs of GNSS
-            for measurement in self.dataset.generate_initialization_gnss_imu():
+            for measurement in self.dataset.generate_initialization_gnss_imu_blocks():
                 if measurement.measurement_type.value == "GNSS":
                     if imu_measurements:
                         self.time_stamps.append(measurement.time.to_time())
+                        imu_block = IMUBlock.concatenate(imu_measurements)
                         integrated_measurement = self.pre_integrate_imu_measurement(
-                            imu_measurements)
+                            imu_block)
                         self.add_imu_factor_gnss(
-                            integrated_measurement, imu_measurements)
+                            integrated_measurement, imu_block)
 
                         # Reset the IMU measurement list
                         imu_measurements = []
@@ -250,7 +252,7 @@ class GtSAMTest:
                     self.graph_values.insert(
                         self.imu_bias_variables[-1], self.current_bias)
 
-                elif measurement.measurement_type.value == "IMU":
+                elif measurement.measurement_type.value == "IMU_Block":
                     imu_measurements.append(measurement)
 
                 if gnss_counter == 2:
@@ -267,15 +269,16 @@ class GtSAMTest:
 
         imu_measurements = []
         length_of_preinitialization = len(self.pose_variables)
-        for measurement in self.dataset.generate_measurements():
+        for measurement in self.dataset.generate_measurement_blocks():
 
             if measurement.measurement_type.value == "UWB":
                 if imu_measurements:
                     self.time_stamps.append(measurement.time.to_time())
+                    imu_block = IMUBlock.concatenate(imu_measurements)
                     integrated_measurement = self.pre_integrate_imu_measurement(
-                        imu_measurements)
+                        imu_block)
                     self.add_imu_factor(
-                        integrated_measurement, imu_measurements)
+                        integrated_measurement, imu_block)
 
                     # Reset the IMU measurement list
                     imu_measurements = []
@@ -286,8 +289,8 @@ class GtSAMTest:
                 # if not (700 < len(self.pose_variables) < 1100):
                 #    self.add_UWB_to_graph(measurement)
 
-            elif measurement.measurement_type.value == "IMU":
-                # Store the IMU factors unntil a new UWB measurement is recieved
+            elif measurement.measurement_type.value == "IMU_Block":
+                # Store the IMU blocks unntil a new UWB measurement is recieved
                 imu_measurements.append(measurement)
 
             iteration_number += 1
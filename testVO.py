@@ -5,6 +5,7 @@ from settings import DATASET_NUMBER
 import numpy as np
 from scipy.spatial.transform import Rotation as R
 from Sensors.CameraSensor.visualOdometry import VisualOdometry
+from Sensors.CameraSensor.visualizationSink import VisualizationSink
 from Plotting.plot_gtsam import plot_position, plot_angels, plot_threedof
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -37,7 +38,7 @@ class CameraUwbImuFusion:
         self.initial_state[:3, 3] = T_init.T
 
         # Initialize vo
-        self.visual_odometry = VisualOdometry()
+        self.visual_odometry = VisualOdometry(visualization=VisualizationSink())
         self.visual_odometry.update_scale(0.25)
 
     def run(self):
@@ -57,6 +58,7 @@ class CameraUwbImuFusion:
             if iteration_number_cam > 2000:
                 break
 
+        self.visual_odometry.visualization.close()
         states = self.visual_odometry.states
 
         for i in range(len(states)):
@@ -78,5 +80,7 @@ class CameraUwbImuFusion:
         plt.show()
 
 
-fusion = CameraUwbImuFusion()
-fusion.run()
+# The guard keeps the visualization process from running the VO when it imports this module
+if __name__ == "__main__":
+    fusion = CameraUwbImuFusion()
+    fusion.run()
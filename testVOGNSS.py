@@ -15,6 +15,9 @@ from Utils.gtsam_pose_utils import gtsam_pose_from_result, gtsam_landmark_from_r
 from Plotting.plot_gtsam import plot_horizontal_trajectory, plot_position, plot_angels, plot_threedof2, plot_threedof_error, new_xy_plot, ATE
 import seaborn as sns
 from Sensors.CameraSensor.visualOdometry import VisualOdometry
+from Sensors.CameraSensor.visualizationSink import VisualizationSink
+from Sensors.CameraSensor.visualOdometryCache import VisualOdometryCache
+from Sensors.CameraSensor.camera import PinholeCamera
 
 from voGNSSTuning import *
 
@@ -22,7 +25,8 @@ from voGNSSTuning import *
 class GtSAMTest:
 
     def __init__(self) -> None:
-        self.dataset: ROSData = ROSData(DATASET_NUMBER)
+        self.dataset: ROSData = ROSData(DATASET_NUMBER, decode_workers=DECODE_WORKERS,
+                                         decode_options=dict(reduction=PinholeCamera(VO_PROCESSING_SCALE).decode_reduction()))
         isam_params: gtsam.ISAM2Params = gtsam.ISAM2Params()
         isam_params.setFactorization("QR")
         isam_params.setRelinearizeSkip(1)
@@ -85,7 +89,17 @@ class GtSAMTest:
         self.time_stamps.append(self.ground_truth.time[0])
         self.prev_image_state = None
 
-        self.visual_odometry = VisualOdometry(noise_values=VO_SIGMAS)
+        self.visual_odometry = VisualOdometry(noise_values=VO_SIGMAS, processing_scale=VO_PROCESSING_SCALE, keyframe_parallax=VO_KEYFRAME_PARALLAX,
+                                              bundle_adjustment_window=VO_BUNDLE_ADJUSTMENT_WINDOW, visualization=VisualizationSink() if SHOW_VO_FRAMES else None)
+        # Replays the VO motions of an earlier run with the same dataset window and VO settings, unless they depend on the fusion
+        self.vo_cache = None
+        if VO_CACHE and not self.visual_odometry.cacheable():
+            print("The VO uses the bundle adjustment, it is not cached")
+        elif VO_CACHE:
+            self.vo_cache = VisualOdometryCache(self.dataset.dataset_settings, self.visual_odometry)
+        if self.vo_cache is not None and self.vo_cache.replaying:
+            # The cached frames are not decoded, the frames after them are decoded when tracked
+            self.dataset.stop_image_decoder()
 
     def reset_pose_graph_variables(self):
         self.graph_values = gtsam.Values()
@@ -168,6 +182,11 @@ class GtSAMTest:
     def calculateScale(self, trajectoryLengthGNSS):
         return self.calculateTrajectoryLength(np.zeros((3, 1)), self.visual_odometry.states[-1][:3, 3])/trajectoryLengthGNSS
 
+    def track_frame(self, measurement):
+        if self.vo_cache is None:
+            return self.visual_odometry.track(measurement.image)
+        return self.vo_cache.track(self.visual_odometry, measurement)
+
     def run(self):
         # Dummy variable for storing imu measurements
         imu_measurements = []
@@ -202,7 +221,7 @@ class GtSAMTest:
                     imu_measurements.append(measurement)
 
                 elif measurement.measurement_type.value == "Camera":
-                    self.visual_odometry.track(measurement.image)
+                    self.track_frame(measurement)
 
                 if gnss_counter == 2:
                     self.isam.update(self.factor_graph, self.graph_values)
@@ -234,13 +253,16 @@ class GtSAMTest:
             if measurement.measurement_type.value == "Camera":
 
                 if self.prev_image_state is None:
-                    self.visual_odometry.track(measurement.image)
+                    self.track_frame(measurement)
                     self.prev_image_state = self.pose_variables[-1]
                 else:
-                    rotation, trans = self.visual_odometry.track(measurement.image)
-                    self.add_vo_to_graph(rotation, trans)
-                    self.time_stamps.append(measurement.time.to_time())
-                    self.prev_image_state = self.pose_variables[-1]
+                    # Frames skipped by the keyframe policy give no result and no new state
+                    vo_result = self.track_frame(measurement)
+                    if vo_result is not None:
+                        rotation, trans = vo_result
+                        self.add_vo_to_graph(rotation, trans)
+                        self.time_stamps.append(measurement.time.to_time())
+                        self.prev_image_state = self.pose_variables[-1]
 
             iteration_number += 1
             print("Iteration", iteration_number, len(self.pose_variables), len(self.time_stamps))
@@ -262,6 +284,10 @@ class GtSAMTest:
                 if len(self.pose_variables) > NUMBER_OF_RUNNING_ITERATIONS:
                     break
 
+        if self.vo_cache is not None:
+            self.vo_cache.save()
+        if self.visual_odometry.visualization is not None:
+            self.visual_odometry.visualization.close()
         self.isam.update(self.factor_graph, self.graph_values)
         result = self.isam.calculateBestEstimate()
         positions, eulers = gtsam_pose_from_result(result)
@@ -294,5 +320,7 @@ class GtSAMTest:
         plt.show()
 
 
-testing = GtSAMTest()
-testing.run()
+# The guard keeps the image decoding processes from running the fusion when they import this module
+if __name__ == "__main__":
+    testing = GtSAMTest()
+    testing.run()
@@ -28,5 +28,37 @@ GNSS_PREINIT_ENABLED = True
 GNSS_NOISE = np.array([0.8, 0.8, 0.5, 1, 1, 5])
 GNSS_VELOCITY_SIGMAS = np.array([0.1, 0.1, 0.01])
 
+# Measurement read-ahead queue size, 0 disables the producer thread
+PREFETCH_SIZE = 256
+
+# Number of processes decoding the camera frames, 0 decodes in the fusion loop
+DECODE_WORKERS = 4
+
+# Resolution scale of the frames processed by the VO, 1/2, 1/4 and 1/8 are decoded directly at that size
+VO_PROCESSING_SCALE = 1.0
+
+# Run the VO in a separate process, the results are added to the graph when they arrive
+ASYNC_VO = True
+
+# VO keyframes, frames with a median feature displacement below VO_KEYFRAME_PARALLAX pixels are skipped, 0 keeps every frame
+VO_KEYFRAME_PARALLAX = 0.0
+# and so are frames where the IMU moved less than both VO_KEYFRAME_ROTATION [rad] and VO_KEYFRAME_TRANSLATION [m] since the last keyframe,
+# e.g. np.radians(0.2) and 0.05, 0 keeps every frame
+VO_KEYFRAME_ROTATION = 0.0
+VO_KEYFRAME_TRANSLATION = 0.0
+
+# Estimate only the VO translation, with the rotation since the last keyframe taken from the IMU preintegration.
+# Off by default, with a noisy rotation prior the two-point translation is less accurate, see benchmarkVOGeometry.py
+VO_IMU_AIDED = False
+
+# Local bundle adjustment over the last VO_BUNDLE_ADJUSTMENT_WINDOW VO keyframes, off if below 2
+VO_BUNDLE_ADJUSTMENT_WINDOW = 0
+
+# Cache the VO motions of the dataset window on disk and replay them in later runs with the same VO settings
+VO_CACHE = True
+
+# Show the tracked VO frames in a window, the runs are headless if False
+SHOW_VO_FRAMES = False
+
 # Other constants
 NUMBER_OF_RUNNING_ITERATIONS = 4000  # Full traj is about 3000
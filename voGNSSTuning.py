@@ -30,5 +30,23 @@ GNSS_NOISE_RUNNING = np.array([0.8, 0.8, 1.5, 0.5, 0.5, 5])
 
 GNSS_VELOCITY_SIGMAS = np.array([0.1, 0.1, 0.01])
 
+# Number of processes decoding the camera frames, 0 decodes in the fusion loop
+DECODE_WORKERS = 4
+
+# Resolution scale of the frames processed by the VO, 1/2, 1/4 and 1/8 are decoded directly at that size
+VO_PROCESSING_SCALE = 1.0
+
+# VO keyframes, frames with a median feature displacement below VO_KEYFRAME_PARALLAX pixels are skipped, 0 keeps every frame
+VO_KEYFRAME_PARALLAX = 0.0
+
+# Local bundle adjustment over the last VO_BUNDLE_ADJUSTMENT_WINDOW VO keyframes, off if below 2
+VO_BUNDLE_ADJUSTMENT_WINDOW = 0
+
+# Cache the VO motions of the dataset window on disk and replay them in later runs with the same VO settings
+VO_CACHE = True
+
+# Show the tracked VO frames in a window, the runs are headless if False
+SHOW_VO_FRAMES = False
+
 # Other constants
 NUMBER_OF_RUNNING_ITERATIONS = 2000  # Full traj is about 3000